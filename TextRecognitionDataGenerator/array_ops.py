@@ -0,0 +1,159 @@
+import math
+import cv2
+import numpy as np
+
+from distorsion_generator import DistorsionGenerator
+
+# OpenCV counterparts of the PIL resampling filters used by the generator
+RESAMPLING = {
+    'bilinear': cv2.INTER_LINEAR,
+    'lanczos': cv2.INTER_LANCZOS4,
+}
+
+def rotation_geometry(height, width, angle):
+    """
+        Size of a height x width image rotated counterclockwise by angle
+        degrees and grown to fit, like PIL's rotate(angle, expand=1), and the
+        2 x 3 matrix mapping its pixel centers back to the source image
+    """
+
+    radians = -math.radians(angle)
+    a, b = round(math.cos(radians), 15), round(math.sin(radians), 15)
+    d, e = -b, a
+
+    # Output size from the rotated corners, the same way PIL computes it
+    center_x, center_y = width / 2.0, height / 2.0
+    corners = ((0, 0), (width, 0), (width, height), (0, height))
+    xs = [a * (x - center_x) + b * (y - center_y) + center_x for x, y in corners]
+    ys = [d * (x - center_x) + e * (y - center_y) + center_y for x, y in corners]
+    new_width = math.ceil(max(xs)) - math.floor(min(xs))
+    new_height = math.ceil(max(ys)) - math.floor(min(ys))
+
+    # Inverse map from output to input coordinates, between pixel centers
+    offset_x = -(new_width - width) / 2.0 - center_x
+    offset_y = -(new_height - height) / 2.0 - center_y
+    c = a * offset_x + b * offset_y + center_x
+    f = d * offset_x + e * offset_y + center_y
+    matrix = np.array([
+        [a, b, c + 0.5 * (a + b) - 0.5],
+        [d, e, f + 0.5 * (d + e) - 0.5],
+    ])
+
+    return new_height, new_width, matrix
+
+def rotate_expand(img, angle):
+    """
+        Rotate a uint8 image counterclockwise by angle degrees around its
+        center, growing it to fit like PIL's rotate(angle, expand=1) with
+        nearest neighbour sampling and black corners
+    """
+
+    if angle % 360.0 == 0:
+        return img
+
+    new_height, new_width, matrix = rotation_geometry(img.shape[0], img.shape[1], angle)
+
+    return cv2.warpAffine(
+        img, matrix, (new_width, new_height),
+        flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_CONSTANT, borderValue=0
+    )
+
+def fused_warp(img, angle, f, distorsion=None):
+    """
+        Rotate (as rotate_expand), scale by f (as resize) and apply a
+        distorsion in a single bilinear resampling of the text. distorsion
+        is None or (vertical, horizontal, max_offset, func) as given to
+        DistorsionGenerator.apply_func_distorsion.
+
+        Rotation and scaling compose into one affine map. The distorsion
+        moves pixels of the scaled image by whole pixels, so it composes
+        exactly with that map: every output pixel is traced back to the
+        source through both and interpolated once. f stays close to 1 in
+        the generator, bilinear does not alias at those scales.
+    """
+
+    height, width = img.shape
+    if angle % 360.0 == 0:
+        rotated_height, rotated_width, matrix = height, width, np.array([[1.0, 0, 0], [0, 1.0, 0]])
+    else:
+        rotated_height, rotated_width, matrix = rotation_geometry(height, width, angle)
+
+    # Same output size as the separate resize
+    scaled_height, scaled_width = int(rotated_height * f), int(rotated_width * f)
+
+    # Scaled pixel centers to rotated ones, then to the source
+    scale_x = rotated_width / scaled_width
+    scale_y = rotated_height / scaled_height
+    linear = matrix[:, :2] * [scale_x, scale_y]
+    translation = matrix[:, :2].dot([0.5 * scale_x - 0.5, 0.5 * scale_y - 0.5]) + matrix[:, 2]
+    composed = np.hstack([linear, translation[:, None]])
+
+    if distorsion is None:
+        return cv2.warpAffine(
+            img, composed, (scaled_width, scaled_height),
+            flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_CONSTANT, borderValue=0
+        )
+
+    # Distorted pixels to scaled ones, then to the source
+    rows, cols, valid = DistorsionGenerator.distorsion_indices(scaled_height, scaled_width, *distorsion)
+    points = np.empty(valid.shape + (2,), dtype=np.float32)
+    points[..., 0] = cols
+    points[..., 1] = rows
+    coordinates = cv2.transform(points, composed)
+
+    # Pixels the distorsion uncovers read far outside the source, which is black
+    coordinates[~valid] = -width
+
+    return cv2.remap(img, coordinates, None, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+def resize(img, f, resample):
+    """
+        Scale a uint8 image by f, resample is one of antialias, bilinear or lanczos
+    """
+
+    size = (int(img.shape[1] * f), int(img.shape[0] * f))
+    if resample == 'antialias':
+        # Area averaging is the antialiased filter when shrinking
+        interpolation = cv2.INTER_AREA if f < 1 else cv2.INTER_LANCZOS4
+    else:
+        interpolation = RESAMPLING[resample]
+    return cv2.resize(img, size, interpolation=interpolation)
+
+def paste_masked(background, img, x, y):
+    """
+        Paste img into background, in place, at (x, y). Pure black and pure
+        white pixels of img are transparent, what falls outside of the
+        background is dropped.
+    """
+
+    height = min(img.shape[0], background.shape[0] - y)
+    width = min(img.shape[1], background.shape[1] - x)
+    if height <= 0 or width <= 0:
+        return background
+
+    img = img[:height, :width]
+    region = background[y:y + height, x:x + width]
+    mask = (img != 0) & (img != 255)
+    np.copyto(region, img, where=mask)
+
+    return background
+
+def gaussian_blur(img, radius):
+    """
+        Gaussian blur of standard deviation radius, in place
+    """
+
+    if radius > 0:
+        cv2.GaussianBlur(img, (0, 0), radius, dst=img)
+    return img
+
+def encode(img, extension):
+    """
+        Encode a single channel uint8 image to the bytes of an image file
+    """
+
+    params = [cv2.IMWRITE_JPEG_QUALITY, 75] if extension.lower() in ('jpg', 'jpeg') else []
+    success, encoded = cv2.imencode('.' + extension, img, params)
+    if not success:
+        raise Exception('Could not encode image as {}'.format(extension))
+    return encoded.tobytes()
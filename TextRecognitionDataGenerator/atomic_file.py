@@ -0,0 +1,23 @@
+import os
+
+from contextlib import contextmanager
+
+@contextmanager
+def atomic_open(path, mode='wb', encoding=None):
+    """
+        Open path for writing through a temporary file of this process, renamed
+        over path once it is complete: concurrent workers, concurrent runs and
+        interrupted ones never see a partial file. Nothing is left behind when
+        writing fails.
+    """
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, mode, encoding=encoding) as f:
+            yield f
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    os.replace(tmp_path, path)
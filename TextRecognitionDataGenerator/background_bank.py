@@ -0,0 +1,120 @@
+import os
+import random
+import numpy as np
+
+from atomic_file import atomic_open
+
+# Default of the configure arguments that None is a valid value for
+_UNSET = object()
+
+class BackgroundBank(object):
+    """
+        Large pre-rendered background tiles, per kind of synthesized
+        background, served as random crops.
+
+        Tiles are rendered once per process, or once for good when cache_dir
+        is set: they are then saved as raw .npy files and memory-mapped from
+        there. Each tile comes from its own generator seeded from seed, kind
+        and index, so every process and every run sees the same bank.
+
+        A crop picks a tile, an offset in it and whether to flip it on each
+        axis, so the per-sample cost of a background is a copy of a slice.
+        Backgrounds bigger than a tile return None and are synthesized as
+        usual by the caller.
+    """
+
+    tile_count = 0
+    tile_height = 256
+    tile_width = 2048
+    seed = 0
+    cache_dir = None
+
+    __tiles = {}
+
+    @classmethod
+    def configure(cls, tile_count=None, tile_height=None, tile_width=None, seed=None, cache_dir=_UNSET):
+        """
+            Change the bank settings, tiles are rendered (or loaded) again on next use.
+            Settings left out are kept, cache_dir=None turns the disk cache off.
+        """
+
+        if tile_count is not None:
+            cls.tile_count = tile_count
+        if tile_height is not None:
+            cls.tile_height = tile_height
+        if tile_width is not None:
+            cls.tile_width = tile_width
+        if seed is not None:
+            cls.seed = seed
+        if cache_dir is not _UNSET:
+            cls.cache_dir = cache_dir
+        cls.__tiles = {}
+
+    @classmethod
+    def enabled(cls):
+        return cls.tile_count > 0
+
+    @classmethod
+    def __render(cls, kind, index, render):
+        rng = random.Random('{}-{}-{}'.format(cls.seed, kind, index))
+        return render(cls.tile_height, cls.tile_width, rng)
+
+    @classmethod
+    def __load(cls, kind, index, render):
+        """
+            Return a read-only memory map of a cached tile, rendering it if needed
+        """
+
+        os.makedirs(cls.cache_dir, exist_ok=True)
+
+        path = os.path.join(
+            cls.cache_dir,
+            '{}.{}.{}.{}x{}.npy'.format(kind, cls.seed, index, cls.tile_height, cls.tile_width)
+        )
+        if not os.path.exists(path):
+            with atomic_open(path) as f:
+                np.save(f, cls.__render(kind, index, render))
+
+        return np.load(path, mmap_mode='r')
+
+    @classmethod
+    def tiles(cls, kind, render):
+        """
+            Return the tiles of a kind of background, rendering them on first
+            use with render(height, width, rng), rng being a random.Random
+        """
+
+        tiles = cls.__tiles.get(kind)
+        if tiles is None:
+            if cls.cache_dir is not None:
+                tiles = [cls.__load(kind, i, render) for i in range(cls.tile_count)]
+            else:
+                tiles = [cls.__render(kind, i, render) for i in range(cls.tile_count)]
+            cls.__tiles[kind] = tiles
+
+        return tiles
+
+    @classmethod
+    def crop(cls, kind, height, width, render):
+        """
+            Return a random, randomly flipped, height x width crop of a tile
+            of the given kind as a writable array, None when it does not fit
+        """
+
+        if height > cls.tile_height or width > cls.tile_width:
+            return None
+
+        tiles = cls.tiles(kind, render)
+        tile = tiles[random.randint(0, len(tiles) - 1)]
+
+        y = random.randint(0, cls.tile_height - height)
+        x = random.randint(0, cls.tile_width - width)
+        crop = tile[y:y + height, x:x + width]
+
+        if random.randint(0, 1) == 0:
+            crop = crop[:, ::-1]
+        if random.randint(0, 1) == 0:
+            crop = crop[::-1]
+
+        # The caller draws over the crop, the tile must stay untouched
+        return np.array(crop)
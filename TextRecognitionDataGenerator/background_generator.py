@@ -1,19 +1,32 @@
 import cv2
 import math
-import os
 import random
 import numpy as np
-import glob
+from collections import OrderedDict
 from PIL import Image, ImageFont, ImageDraw, ImageFilter
 
+from picture_pool import PicturePool
+from background_bank import BackgroundBank
+
 
 class BackgroundGenerator(object):
+    grid_cache_size = 64
+    # Typical sample size, bank tiles of quasicrystal are rendered with its pixel spacing
+    quasicrystal_tile_sample = (40, 160)
+
+    __grid_cache = OrderedDict()
+
     @classmethod
     def gaussian_noise(cls, height, width):
         """
             Create a background with Gaussian noise (to mimic paper)
         """
 
+        if BackgroundBank.enabled():
+            crop = BackgroundBank.crop('gaussian_noise', height, width, cls.gaussian_noise_tile)
+            if crop is not None:
+                return Image.fromarray(crop, 'L')
+
         # We create an all white image
         image = np.ones((height, width)) * 255
 
@@ -30,66 +43,146 @@ class BackgroundGenerator(object):
 
         return Image.new("L", (width, height), 255)
 
+    @classmethod
+    def __quasicrystal_grids(cls, height, width, sample_height, sample_width):
+        """
+            Return the (radius, angle) polar grids for an image of the given
+            size, spaced like the pixels of a sample_height x sample_width image
+        """
+
+        key = (height, width, sample_height, sample_width)
+        grids = cls.__grid_cache.get(key)
+        if grids is not None:
+            cls.__grid_cache.move_to_end(key)
+            return grids
+
+        # Same coordinate system as the historical per-pixel loop: x runs along
+        # the rows, y along the columns, both spanning [-2pi, 2pi] over the sample
+        x_span = 2 * math.pi * (height - 1) / max(sample_height - 1, 1)
+        y_span = 2 * math.pi * (width - 1) / max(sample_width - 1, 1)
+        x = np.linspace(-x_span, x_span, height)[:, None]
+        y = np.linspace(-y_span, y_span, width)[None, :]
+
+        grids = (np.hypot(x, y), np.arctan2(y, x))
+        cls.__grid_cache[key] = grids
+        while len(cls.__grid_cache) > cls.grid_cache_size:
+            cls.__grid_cache.popitem(last=False)
+
+        return grids
+
     @classmethod
     def quasicrystal(cls, height, width):
         """
             Create a background with quasicrystal (https://en.wikipedia.org/wiki/Quasicrystal)
         """
 
-        image = Image.new("L", (width, height))
-        pixels = image.load()
-
-        frequency = random.random() * 30 + 20  # frequency
-        phase = random.random() * 2 * math.pi  # phase
-        rotation_count = random.randint(10, 20)  # of rotations
-
-        for kw in range(width):
-            y = float(kw) / (width - 1) * 4 * math.pi - 2 * math.pi
-            for kh in range(height):
-                x = float(kh) / (height - 1) * 4 * math.pi - 2 * math.pi
-                z = 0.0
-                for i in range(rotation_count):
-                    r = math.hypot(x, y)
-                    a = math.atan2(y, x) + i * math.pi * 2.0 / rotation_count
-                    z += math.cos(r * math.sin(a) * frequency + phase)
-                c = int(255 - round(255 * z / rotation_count))
-                pixels[kw, kh] = c  # grayscale
-        return image
+        return Image.fromarray(cls.quasicrystal_array(height, width), 'L')
+
+    @classmethod
+    def quasicrystal_array(cls, height, width):
+        """
+            Quasicrystal background as a uint8 array
+        """
+
+        if BackgroundBank.enabled():
+            crop = BackgroundBank.crop(cls.__quasicrystal_tile_kind(), height, width, cls.quasicrystal_tile)
+            if crop is not None:
+                return crop
+
+        return cls.quasicrystal_pattern(height, width)
+
+    @classmethod
+    def quasicrystal_pattern(cls, height, width, rng=random, sample_size=None):
+        """
+            Render a quasicrystal of the given size, its parameters drawn from rng.
+            The pattern spans the image unless sample_size, a (height, width),
+            gives the image whose pixel spacing to use instead.
+        """
+
+        frequency = rng.random() * 30 + 20  # frequency
+        phase = rng.random() * 2 * math.pi  # phase
+        rotation_count = rng.randint(10, 20)  # of rotations
+
+        r, a = cls.__quasicrystal_grids(height, width, *(sample_size or (height, width)))
+
+        z = np.zeros((height, width))
+        for i in range(rotation_count):
+            z += np.cos(r * np.sin(a + i * math.pi * 2.0 / rotation_count) * frequency + phase)
+
+        c = 255 - np.round(255 * z / rotation_count)
+
+        return np.clip(c, 0, 255).astype(np.uint8)
+
+    @classmethod
+    def quasicrystal_tile(cls, height, width, rng=random):
+        """
+            Render a bank tile of quasicrystal: crops of it must look like the
+            pattern synthesized for a sample, not like a zoomed in quasicrystal
+        """
+
+        return cls.quasicrystal_pattern(height, width, rng, cls.quasicrystal_tile_sample)
+
+    @classmethod
+    def __quasicrystal_tile_kind(cls):
+        # Tiles cached on disk are only valid for the spacing they were rendered with
+        return 'quasicrystal-{}x{}'.format(*cls.quasicrystal_tile_sample)
 
     @classmethod
     def picture(cls, height, width):
         """
             Create a background with a picture
         """
-        pictures = glob.glob(os.path.join("./pictures", '*.png')) + \
-                   glob.glob(os.path.join("./pictures", '*.jpg')) + \
-                   glob.glob(os.path.join("./pictures", '*.jpeg')) + \
-                   glob.glob(os.path.join("./pictures", '*.tif'))
-        # pictures = os.listdir('./pictures/*.png')
-        if len(pictures) > 0:
-            picture = Image.open(pictures[random.randint(0, len(pictures) - 1)])
-
-            if picture.size[0] < width:
-                picture = picture.resize([width, int(picture.size[1] * (width / picture.size[0]))], Image.ANTIALIAS)
-            if picture.size[1] < height:
-                picture = picture.resize([int(picture.size[0] * (height / picture.size[1])), height], Image.ANTIALIAS)
-
-            if (picture.size[0] == width):
-                x = 0
-            else:
-                x = random.randint(0, picture.size[0] - width)
-            if (picture.size[1] == height):
-                y = 0
-            else:
-                y = random.randint(0, picture.size[1] - height)
-
-            return picture.crop(
-                (
-                    x,
-                    y,
-                    x + width,
-                    y + height,
-                )
-            )
-        else:
-            raise Exception('No images where found in the pictures folder!')
\ No newline at end of file
+
+        return Image.fromarray(np.array(PicturePool.crop(height, width)), 'L')
+
+    @classmethod
+    def gaussian_noise_array(cls, height, width):
+        """
+            Gaussian noise background drawn straight into a uint8 array
+        """
+
+        if BackgroundBank.enabled():
+            crop = BackgroundBank.crop('gaussian_noise', height, width, cls.gaussian_noise_tile)
+            if crop is not None:
+                return crop
+
+        image = np.empty((height, width), dtype=np.uint8)
+        cv2.randn(image, 235, 10)
+        return image
+
+    @classmethod
+    def gaussian_noise_tile(cls, height, width, rng=random):
+        """
+            Gaussian noise of the given size as a uint8 array, drawn from rng
+            instead of the OpenCV generator
+        """
+
+        noise = np.random.RandomState(rng.getrandbits(32)).normal(235, 10, (height, width))
+        return np.clip(np.rint(noise), 0, 255).astype(np.uint8)
+
+    @classmethod
+    def fill_bank(cls):
+        """
+            Render (or load) the tiles of the background bank now, before the
+            pool workers are started, so they all share them
+        """
+
+        if BackgroundBank.enabled():
+            BackgroundBank.tiles('gaussian_noise', cls.gaussian_noise_tile)
+            BackgroundBank.tiles(cls.__quasicrystal_tile_kind(), cls.quasicrystal_tile)
+
+    @classmethod
+    def plain_white_array(cls, height, width):
+        """
+            Plain white background as a uint8 array
+        """
+
+        return np.full((height, width), 255, dtype=np.uint8)
+
+    @classmethod
+    def picture_array(cls, height, width):
+        """
+            Picture background as a writable uint8 array
+        """
+
+        return np.array(PicturePool.crop(height, width))
@@ -0,0 +1,184 @@
+import os
+import random
+import numpy as np
+
+from collections import deque
+from multiprocessing import Pool
+
+from background_generator import BackgroundGenerator
+from data_generator import FakeTextDataGenerator
+from font_cache import FontCache
+from picture_pool import PicturePool
+try:
+    from handwritten_text_generator import HandwrittenTextGenerator
+except ImportError:
+    print('Missing modules for handwritten text generation.')
+
+# Generation settings, pipeline and image ring (None when images are pickled) of the pool workers, set once by init_worker
+worker_settings = None
+worker_pipeline = None
+worker_ring = None
+
+def init_worker(settings, pipeline, font_cache_size, ring):
+    global worker_settings, worker_pipeline, worker_ring
+    worker_settings = settings
+    worker_pipeline = pipeline
+    worker_ring = ring
+    FontCache.configure(font_cache_size)
+
+    if settings['is_handwritten']:
+        HandwrittenTextGenerator.warm_up()
+
+def generate_batch(tasks, slots=None):
+    """
+        Generate the (uint8 array, label) samples of a list of (index, text,
+        font, height) tasks. With slots, the arrays are written to those slots
+        of the worker ring and replaced by their descriptors.
+    """
+
+    batch = []
+    for i, (index, text, font, height) in enumerate(tasks):
+        if worker_pipeline != 'pil':
+            image, _ = FakeTextDataGenerator.generate_array(
+                index, text, font, height, fused_warp=(worker_pipeline == 'fused'), **worker_settings
+            )
+        else:
+            image, _ = FakeTextDataGenerator.generate_image(index, text, font, height, **worker_settings)
+            image = np.asarray(image.convert('L'), dtype=np.uint8)
+        batch.append((worker_ring.write(slots[i], image) if slots is not None else image, text))
+    return batch
+
+class BatchGenerator(object):
+    """
+        Iterate over batches of generated samples, straight from memory: every
+        batch is a list of (grayscale uint8 array, label) tuples, in the order
+        of the texts. Nothing is encoded nor written to disk.
+
+        Batches are generated by a pool of worker processes, at most prefetch
+        of them are in flight or waiting to be consumed at any time, so the
+        workers only run ahead of the training loop by a bounded amount.
+
+        With transport='shared_memory' the workers write the pixels to a
+        SharedRing of (prefetch + 1) * batch_size slots of slot_bytes and
+        only descriptors go through the pool pipes. The arrays of a batch are
+        then views of the ring, valid until the next batch is requested: copy
+        (or stack) them before moving on. Images bigger than a slot are
+        pickled as usual.
+
+        Usage:
+
+            batches = BatchGenerator(itertools.cycle(texts), fonts, batch_size=64, processes=4)
+            for batch in batches:
+                images, labels = zip(*batch)
+    """
+
+    def __init__(self, texts, fonts, batch_size=32, processes=None, prefetch=None, height=32, seed=None,
+                 skewing_angle=0, random_skew=False, blur=0, random_blur=False, background_type=0,
+                 distorsion_type=0, distorsion_orientation=0, is_handwritten=False, text_color=-1,
+                 render_backend="freetype", font_cache_size=32, transport="pipe", slot_bytes=512 * 1024,
+                 pipeline="pil"):
+        """
+            texts is any iterable of strings, iteration stops when it is
+            exhausted. height is either a text height or a (low, high) range
+            to draw it from. A seed makes every batch reproducible. pipeline
+            picks FakeTextDataGenerator.generate_image (pil), generate_array
+            (array) or generate_array with fused_warp (fused).
+        """
+
+        if len(fonts) == 0:
+            raise Exception('At least one font is needed')
+        if transport not in ('pipe', 'shared_memory'):
+            raise Exception('{} is not a valid transport'.format(transport))
+
+        self.texts = texts
+        self.fonts = fonts
+        self.batch_size = batch_size
+        self.processes = processes
+        self.prefetch = prefetch
+        self.height = height
+        self.seed = seed if seed is not None else random.SystemRandom().getrandbits(32)
+        self.font_cache_size = font_cache_size
+        self.transport = transport
+        self.slot_bytes = slot_bytes
+        self.pipeline = pipeline
+        self.settings = {
+            'skewing_angle': skewing_angle,
+            'random_skew': random_skew,
+            'blur': blur,
+            'random_blur': random_blur,
+            'background_type': background_type,
+            'distorsion_type': distorsion_type,
+            'distorsion_orientation': distorsion_orientation,
+            'is_handwritten': is_handwritten,
+            'text_color': text_color,
+            'render_backend': render_backend,
+            'seed': self.seed,
+        }
+
+    def task_batches(self):
+        """
+            Yield the task lists of the batches, fonts and heights are drawn
+            from their own generator so the caller's random state is left alone
+        """
+
+        rng = random.Random(self.seed)
+        low, high = self.height if isinstance(self.height, (tuple, list)) else (self.height, self.height)
+
+        tasks = []
+        for index, text in enumerate(self.texts):
+            tasks.append((index, text, self.fonts[rng.randrange(0, len(self.fonts))], rng.randint(low, high)))
+            if len(tasks) == self.batch_size:
+                yield tasks
+                tasks = []
+        if len(tasks) > 0:
+            yield tasks
+
+    def __iter__(self):
+        processes = self.processes if self.processes is not None else os.cpu_count()
+        prefetch = self.prefetch if self.prefetch is not None else 2 * processes
+
+        # Decode the background pictures and render the background tiles once so the workers share them
+        PicturePool.pictures()
+        BackgroundGenerator.fill_bank()
+
+        # One group of slots per batch in flight, plus the one being consumed
+        group_count = prefetch + 1
+        ring = None
+        if self.transport == 'shared_memory':
+            # multiprocessing.shared_memory needs Python 3.8, only import it when asked for
+            from shared_ring import SharedRing
+            ring = SharedRing(group_count * self.batch_size, self.slot_bytes)
+
+        def submit(pool, tasks, batch_number):
+            slots = None
+            if ring is not None:
+                first = (batch_number % group_count) * self.batch_size
+                slots = list(range(first, first + len(tasks)))
+            return pool.apply_async(generate_batch, (tasks, slots))
+
+        try:
+            with Pool(processes, initializer=init_worker, initargs=(self.settings, self.pipeline, self.font_cache_size, ring)) as pool:
+                task_batches = self.task_batches()
+                submitted = 0
+
+                pending = deque()
+                for tasks in task_batches:
+                    pending.append(submit(pool, tasks, submitted))
+                    submitted += 1
+                    if len(pending) >= prefetch:
+                        break
+
+                while len(pending) > 0:
+                    batch = pending.popleft().get()
+                    # Refill before handing the batch over so workers keep busy while it is consumed,
+                    # the new batch reuses the slots of the one consumed before this one
+                    tasks = next(task_batches, None)
+                    if tasks is not None:
+                        pending.append(submit(pool, tasks, submitted))
+                        submitted += 1
+                    if ring is not None:
+                        batch = [(ring.read(descriptor), label) for descriptor, label in batch]
+                    yield batch
+        finally:
+            if ring is not None:
+                ring.close()
@@ -0,0 +1,295 @@
+import argparse
+import io
+import os
+import sys
+import json
+import time
+import random
+import string
+import platform
+import tempfile
+import cv2
+import numpy as np
+
+from collections import OrderedDict
+from PIL import Image, ImageFilter
+
+from computer_text_generator import ComputerTextGenerator
+from background_generator import BackgroundGenerator
+from distorsion_generator import DistorsionGenerator
+from picture_pool import PicturePool
+from binarization import fast_nick_binarize
+from data_generator import nick_binarize
+
+def prepare_case(text, font, height):
+    """
+        Compute, once and untimed, the intermediate images every stage starts
+        from, in the state FakeTextDataGenerator.generate hands them over
+    """
+
+    image = ComputerTextGenerator.generate(text, font, 40, height)
+    rotated = image.rotate(5, expand=1)
+    distorted = DistorsionGenerator.sin(rotated, vertical=True, horizontal=False, max_offset=2)
+    width, text_height = distorted.size
+    background = BackgroundGenerator.plain_white(text_height + 5, width + 5)
+    mask = distorted.point(lambda x: 0 if x == 255 or x == 0 else 255, '1')
+
+    return {
+        'text': text,
+        'font': font,
+        'height': height,
+        'image': image,
+        'rotated': rotated,
+        'distorted': distorted,
+        'background': background,
+        'mask': mask,
+    }
+
+def resize(image, f, resample):
+    return image.resize((int(image.size[0] * f), int(image.size[1] * f)), resample)
+
+def paste(case):
+    background = case['background'].copy()
+    background.paste(case['distorted'], (5, 5), mask=case['mask'])
+    return background
+
+def encode(image, extension):
+    encoded = io.BytesIO()
+    image.convert('RGB').save(encoded, format=Image.registered_extensions()['.' + extension])
+    return encoded
+
+def save(case, directory):
+    case['background'].convert('RGB').save(os.path.join(directory, 'benchmark.jpg'))
+
+def stages(directory):
+    """
+        Return every stage of the generation pipeline, in pipeline order, as a
+        function of a prepared case
+    """
+
+    return OrderedDict([
+        ('render_freetype', lambda c: ComputerTextGenerator.generate(c['text'], c['font'], 40, c['height'])),
+        ('render_atlas', lambda c: ComputerTextGenerator.generate(c['text'], c['font'], 40, c['height'], 'atlas')),
+        ('rotate', lambda c: c['image'].rotate(5, expand=1)),
+        ('erode', lambda c: cv2.erode(np.array(c['rotated']), np.ones((3, 3), np.uint8), iterations=1)),
+        ('close', lambda c: cv2.morphologyEx(np.array(c['rotated']), cv2.MORPH_CLOSE, np.ones((3, 3), np.uint8))),
+        ('resize_antialias', lambda c: resize(c['rotated'], 1.1, Image.ANTIALIAS)),
+        ('resize_bilinear', lambda c: resize(c['rotated'], 1.1, Image.BILINEAR)),
+        ('resize_lanczos', lambda c: resize(c['rotated'], 1.1, Image.LANCZOS)),
+        ('nick_binarize', lambda c: nick_binarize([np.array(c['rotated'])])),
+        ('fast_nick_binarize', lambda c: fast_nick_binarize([np.array(c['rotated'])])),
+        ('distorsion_sin', lambda c: DistorsionGenerator.sin(c['rotated'], vertical=True, horizontal=False, max_offset=2)),
+        ('distorsion_cos', lambda c: DistorsionGenerator.cos(c['rotated'], vertical=True, horizontal=False, max_offset=2)),
+        ('distorsion_random', lambda c: DistorsionGenerator.random(c['rotated'], vertical=True, horizontal=False)),
+        ('background_gaussian_noise', lambda c: BackgroundGenerator.gaussian_noise(*c['background'].size[::-1])),
+        ('background_plain_white', lambda c: BackgroundGenerator.plain_white(*c['background'].size[::-1])),
+        ('background_quasicrystal', lambda c: BackgroundGenerator.quasicrystal(*c['background'].size[::-1])),
+        ('background_picture', lambda c: BackgroundGenerator.picture(*c['background'].size[::-1])),
+        ('mask', lambda c: c['distorted'].point(lambda x: 0 if x == 255 or x == 0 else 255, '1')),
+        ('paste', paste),
+        ('blur', lambda c: c['background'].filter(ImageFilter.GaussianBlur(radius=1))),
+        ('final_resize', lambda c: resize(c['background'], 1.2, Image.ANTIALIAS)),
+        ('encode_jpg', lambda c: encode(c['background'], 'jpg')),
+        ('encode_png', lambda c: encode(c['background'], 'png')),
+        ('save', lambda c: save(c, directory)),
+    ])
+
+def summarize(durations):
+    """
+        Throughput and percentiles (in milliseconds) of a list of durations in seconds
+    """
+
+    durations = np.array(durations) * 1000
+    return {
+        'calls': len(durations),
+        'mean_ms': float(durations.mean()),
+        'p50_ms': float(np.percentile(durations, 50)),
+        'p90_ms': float(np.percentile(durations, 90)),
+        'p99_ms': float(np.percentile(durations, 99)),
+        'per_second': float(1000 / durations.mean()) if durations.mean() > 0 else float('inf'),
+    }
+
+def run_suite(fonts, heights, lengths, repeat, stage_names=None):
+    """
+        Time every stage on every (font, height, text length) of the grid,
+        repeat times each after one warm up call. Results are keyed by
+        stage/font/height/length, font being the file name of the font.
+    """
+
+    # The same texts on every run so that results stay comparable
+    rng = random.Random(0)
+    texts = {
+        length: ''.join(rng.choice(string.ascii_letters + string.digits + ' ') for _ in range(length))
+        for length in lengths
+    }
+
+    results = OrderedDict()
+    with tempfile.TemporaryDirectory() as directory:
+        for name, stage in stages(directory).items():
+            if stage_names is not None and name not in stage_names:
+                continue
+            if name == 'background_picture' and len(PicturePool.pictures()) == 0:
+                print('Skipping {}, no pictures found'.format(name))
+                continue
+
+            for font in fonts:
+                for height in heights:
+                    for length in lengths:
+                        durations = []
+                        case = prepare_case(texts[length], font, height)
+                        stage(case)
+                        for _ in range(repeat):
+                            start = time.perf_counter()
+                            stage(case)
+                            durations.append(time.perf_counter() - start)
+                        key = '{}/{}/h{}/l{}'.format(name, os.path.basename(font), height, length)
+                        results[key] = summarize(durations)
+
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+        Return the (key, baseline p50, p50) of the cases whose median got
+        slower than the baseline by more than tolerance (a ratio)
+    """
+
+    regressions = []
+    for key, result in results.items():
+        reference = baseline.get(key)
+        if reference is None:
+            continue
+        if result['p50_ms'] > reference['p50_ms'] * (1 + tolerance):
+            regressions.append((key, reference['p50_ms'], result['p50_ms']))
+    return regressions
+
+def print_report(results, baseline=None):
+    print('{:<64} {:>9} {:>9} {:>9} {:>9} {:>10} {:>8}'.format('stage/font/height/length', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'per sec', 'vs base'))
+    for key, result in results.items():
+        ratio = ''
+        if baseline is not None and key in baseline and baseline[key]['p50_ms'] > 0:
+            ratio = '{:.2f}x'.format(result['p50_ms'] / baseline[key]['p50_ms'])
+        print('{:<64} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>10.1f} {:>8}'.format(
+            key, result['mean_ms'], result['p50_ms'], result['p90_ms'], result['p99_ms'], result['per_second'], ratio
+        ))
+
+def parse_arguments():
+    """
+        Parse the command line arguments of the program.
+    """
+
+    parser = argparse.ArgumentParser(description='Time each stage of the generation pipeline in isolation.')
+    parser.add_argument(
+        "-f",
+        "--fonts",
+        type=str,
+        nargs="?",
+        help="Directory of the fonts to benchmark with",
+        default="fonts/latin"
+    )
+    parser.add_argument(
+        "-n",
+        "--font_count",
+        type=int,
+        nargs="?",
+        help="How many fonts of the directory to use",
+        default=3
+    )
+    parser.add_argument(
+        "-hs",
+        "--heights",
+        type=str,
+        nargs="?",
+        help="Comma separated text heights",
+        default="32,64,100"
+    )
+    parser.add_argument(
+        "-ls",
+        "--lengths",
+        type=str,
+        nargs="?",
+        help="Comma separated text lengths, in characters",
+        default="5,20,60"
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        nargs="?",
+        help="Timed calls per font of each case",
+        default=10
+    )
+    parser.add_argument(
+        "-s",
+        "--stages",
+        type=str,
+        nargs="?",
+        help="Comma separated stages to run, all of them when not set",
+        default=""
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        nargs="?",
+        help="Save the results to this JSON file, to be used as a baseline later",
+        default=""
+    )
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        type=str,
+        nargs="?",
+        help="Compare the results to this saved JSON baseline and exit with status 1 on regressions",
+        default=""
+    )
+    parser.add_argument(
+        "-tol",
+        "--tolerance",
+        type=float,
+        nargs="?",
+        help="Median slow down, as a ratio, above which a case is reported as a regression",
+        default=0.15
+    )
+    return parser.parse_args()
+
+def main():
+    """
+        Description: Main function
+    """
+
+    args = parse_arguments()
+
+    fonts = [os.path.join(args.fonts, f) for f in sorted(os.listdir(args.fonts))][0:args.font_count]
+    heights = [int(h) for h in args.heights.split(',')]
+    lengths = [int(l) for l in args.lengths.split(',')]
+    stage_names = args.stages.split(',') if args.stages != '' else None
+
+    PicturePool.load()
+
+    results = run_suite(fonts, heights, lengths, args.repeat, stage_names)
+
+    baseline = None
+    if args.baseline != '':
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+
+    print_report(results, baseline)
+
+    if args.output != '':
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+                'grid': {'fonts': fonts, 'heights': heights, 'lengths': lengths, 'repeat': args.repeat},
+                'results': results,
+            }, f, indent=2)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for key, reference, current in regressions:
+            print('REGRESSION {}: p50 {:.3f} ms -> {:.3f} ms'.format(key, reference, current))
+        if len(regressions) > 0:
+            sys.exit(1)
+        print('No regression above {:.0%}'.format(args.tolerance))
+
+if __name__ == '__main__':
+    main()
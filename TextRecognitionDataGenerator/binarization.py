@@ -0,0 +1,118 @@
+import cv2
+import numpy as np
+
+from PIL import Image
+
+def niblack_threshold(img, window_size=13, k=0.0):
+    """
+        Niblack local threshold (mean - k * std over a window_size square),
+        computed with box filters. Borders are reflected like
+        skimage.filters.threshold_niblack does.
+    """
+
+    img = img.astype(np.float64)
+    mean = cv2.boxFilter(img, -1, (window_size, window_size), borderType=cv2.BORDER_REFLECT_101)
+    if k == 0:
+        return mean
+
+    sqmean = cv2.boxFilter(img * img, -1, (window_size, window_size), borderType=cv2.BORDER_REFLECT_101)
+    return mean - k * np.sqrt(np.clip(sqmean - mean * mean, 0, None))
+
+def otsu_thresholds(histograms):
+    """
+        Otsu threshold of every row of a (n, 256) histogram array, using the
+        same convention as skimage.filters.rank.otsu (pixels above the
+        returned value are foreground)
+    """
+
+    histograms = histograms.astype(np.float64)
+    population = histograms.sum(axis=1, keepdims=True)
+    population[population == 0] = 1
+
+    p = histograms / population
+    levels = np.arange(histograms.shape[1])
+    q1 = np.cumsum(p, axis=1)
+    m1 = np.cumsum(p * levels, axis=1)
+    mu = m1[:, -1:]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mu1 = m1 / q1
+        mu2 = (mu - m1) / (1. - q1)
+        sigma_b = q1 * (1. - q1) * (mu1 - mu2) ** 2
+    sigma_b[~np.isfinite(sigma_b)] = 0
+    sigma_b[:, 0] = 0
+
+    # The first maximum wins, and 0 when no split separates anything
+    thresholds = np.argmax(sigma_b, axis=1)
+    thresholds[sigma_b.max(axis=1) <= 0] = 0
+
+    return thresholds
+
+def local_otsu_thresholds(img_list, radius=101):
+    """
+        Approximate skimage.filters.rank.otsu with a disk of the given radius
+        on line images that are at most radius pixels tall: the disk is
+        replaced by a box of 2 * radius + 1 columns spanning the full height,
+        so the threshold only depends on the column. The per column
+        histograms of every image are laid side by side and integrated once,
+        which gives every window's histogram with a single subtraction.
+
+        Returns one row of per column thresholds for each image.
+    """
+
+    widths = [img.shape[1] for img in img_list]
+    starts = np.cumsum([0] + widths)
+
+    column_histograms = np.concatenate([
+        np.bincount(
+            (np.arange(img.shape[1])[None, :] * 256 + img).ravel(),
+            minlength=img.shape[1] * 256
+        ).reshape(img.shape[1], 256)
+        for img in img_list
+    ])
+    integral = np.zeros((column_histograms.shape[0] + 1, 256), dtype=np.int64)
+    np.cumsum(column_histograms, axis=0, out=integral[1:])
+
+    # Windows are clipped to the image they belong to
+    columns = np.arange(starts[-1])
+    image_starts = np.repeat(starts[:-1], widths)
+    image_ends = np.repeat(starts[1:], widths)
+    low = np.maximum(columns - radius, image_starts)
+    high = np.minimum(columns + radius + 1, image_ends)
+
+    thresholds = otsu_thresholds(integral[high] - integral[low])
+
+    return [thresholds[starts[i]:starts[i + 1]] for i in range(len(img_list))]
+
+def fast_nick_binarize(img_list):
+    '''Binarize linecut images like nick_binarize, with box filter Niblack and
+    column-tiled local Otsu thresholds. The whole list is thresholded as one batch.
+
+    Args:
+        img_list: list of grayscale linecut images
+    Returns:
+        results: binarized images in the same order as the input'''
+
+    resized = []
+    for img in img_list:
+        # Resize the images to 100 pixel height
+        scaling_factor = 100/img.shape[0]
+        new_w = int(scaling_factor*img.shape[1])
+        new_h = int(scaling_factor*img.shape[0])
+        resized.append(np.array(Image.fromarray(img).resize((new_w, new_h), Image.ANTIALIAS)))
+
+    # Second pass thresholds for the whole batch at once
+    otsu = local_otsu_thresholds(resized, radius=101)
+
+    results = []
+    for original, img, th2 in zip(img_list, resized, otsu):
+        # First pass thresholding
+        th1 = niblack_threshold(img, 13, 0.00)
+
+        # Masking
+        mask = (img > th1) | (img > th2[None, :])
+        mask = mask.astype('uint8')*255
+
+        results.append(np.array(Image.fromarray(mask).resize((original.shape[1], original.shape[0]), Image.ANTIALIAS)))
+
+    return results
@@ -0,0 +1,72 @@
+import os
+import mmap
+import numpy as np
+
+from atomic_file import atomic_open
+
+class CompactDict(object):
+    """
+        Read-only list of dictionary lines stored as one UTF-8 blob plus an
+        array of line offsets, both memory-mapped. Processes opening the same
+        dictionary share it through the page cache instead of each holding
+        hundreds of thousands of Python strings.
+
+        Items are returned exactly like readlines() would return them,
+        trailing newline included.
+    """
+
+    directory = os.path.join('cache', 'dicts')
+
+    def __init__(self, blob_path, offsets_path):
+        self.offsets = np.load(offsets_path, mmap_mode='r')
+        with open(blob_path, 'rb') as f:
+            # mmap refuses empty files
+            self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(blob_path) > 0 else b''
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('CompactDict index out of range')
+        return self.blob[int(self.offsets[index]):int(self.offsets[index + 1])].decode('utf-8')
+
+    @classmethod
+    def build(cls, filename, blob_path, offsets_path):
+        """
+            Convert a text dictionary to its blob and offsets files
+        """
+
+        with open(filename, 'r', encoding="utf8", errors='ignore') as d:
+            blob = d.read().encode('utf-8')
+
+        line_ends = np.flatnonzero(np.frombuffer(blob, dtype=np.uint8) == ord('\n')) + 1
+        offsets = np.concatenate([[0], line_ends]).astype(np.int64)
+        if len(blob) > 0 and offsets[-1] != len(blob):
+            # Last line without a trailing newline
+            offsets = np.append(offsets, len(blob))
+
+        with atomic_open(blob_path) as f:
+            f.write(blob)
+        with atomic_open(offsets_path) as f:
+            np.save(f, offsets)
+
+    @classmethod
+    def load(cls, filename):
+        """
+            Open the compact version of a text dictionary, building it first if
+            it does not exist yet or the dictionary changed since
+        """
+
+        stat = os.stat(filename)
+        name = '{}.{}.{}'.format(os.path.basename(filename), stat.st_size, int(stat.st_mtime))
+        blob_path = os.path.join(cls.directory, name + '.blob')
+        offsets_path = os.path.join(cls.directory, name + '.offsets.npy')
+
+        if not os.path.exists(blob_path) or not os.path.exists(offsets_path):
+            os.makedirs(cls.directory, exist_ok=True)
+            cls.build(filename, blob_path, offsets_path)
+
+        return cls(blob_path, offsets_path)
@@ -4,17 +4,29 @@ import random
 import os
 import numpy as np
 
-from PIL import Image, ImageFont, ImageDraw, ImageFilter
+from PIL import Image, ImageDraw, ImageFilter
 from fontTools.ttLib import TTFont
 from fontTools.unicode import Unicode
 from itertools import chain
 
+from font_cache import FontCache
+from glyph_atlas import GlyphAtlas
+
 class ComputerTextGenerator(object):
     @classmethod
-    def generate(cls, text, font, text_color, height):
+    def generate(cls, text, font, text_color, height, render_backend='freetype'):
+        """
+            Render text in black-ish on white. render_backend is either freetype
+            (full layout of every string) or atlas (blit cached glyphs, see GlyphAtlas)
+        """
+
+        if render_backend == 'atlas':
+            fill = random.randint(1, 80) if text_color < 0 else text_color
+            return Image.fromarray(GlyphAtlas.get(font, height).render(u'{0}'.format(text), fill), 'L')
+
         # print(text, font, text_color)
         # image_font = ImageFont.truetype(font="/Library/Fonts/Arial Unicode.ttf", size=32)
-        image_font = ImageFont.truetype(font=font, size=height)
+        image_font = FontCache.get(font, height)
         text_width, text_height = image_font.getsize(text)
 
         # text = u'日産コーポレート/個人ゴールドJBC123JAL'
@@ -25,3 +37,15 @@ class ComputerTextGenerator(object):
         txt_draw.text((0, 0), u'{0}'.format(text), fill=random.randint(1, 80) if text_color < 0 else text_color, font=image_font)
 
         return txt_img
+
+    @classmethod
+    def generate_array(cls, text, font, text_color, height, render_backend='freetype'):
+        """
+            Same as generate, as a uint8 array
+        """
+
+        if render_backend == 'atlas':
+            fill = random.randint(1, 80) if text_color < 0 else text_color
+            return GlyphAtlas.get(font, height).render(u'{0}'.format(text), fill)
+
+        return np.array(cls.generate(text, font, text_color, height, render_backend))
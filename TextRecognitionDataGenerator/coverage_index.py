@@ -0,0 +1,184 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+from multiprocessing import Pool
+from itertools import chain
+from fontTools.ttLib import TTFont
+from fontTools.unicode import Unicode
+from PIL import Image, ImageDraw
+
+from font_cache import FontCache
+from atomic_file import atomic_open
+
+def check_character_in_font(char, font):
+    try:
+        for cmap in font['cmap'].tables:
+            if cmap.isUnicode():
+                if ord(char) in cmap.cmap:
+                    return True
+    except Exception as ex:
+        print(ex)
+        print(u'1{}1'.format(char))
+    return False
+
+def check_character_in_fontc1(char, font, height = 32):
+    image_font = FontCache.get(font, height)
+    text_width, text_height = image_font.getsize(char)
+
+    txt_img = Image.new('L', (text_width, text_height), 255)
+
+    txt_draw = ImageDraw.Draw(txt_img)
+
+    txt_draw.text((0, 0), u'{0}'.format(char), fill=0, font=image_font)
+
+    return len(np.nonzero(np.array(txt_img) != 255)[0]) > 0
+
+def cmap_characters(ttf):
+    """
+        List the characters of every cmap table of the font, a character
+        mapped by several tables is listed once per table
+    """
+
+    return [u'{0}'.format(chr(x[0])) for x in
+            list(chain.from_iterable([y + (Unicode[y[0]],) for y in x.cmap.items()] for x in ttf["cmap"].tables))]
+
+class CoverageIndex(object):
+    """
+        On-disk index of which characters each font can render.
+
+        Entries are keyed by the hash of the font file (and, for coverage, by
+        the hash of the character sets checked), so they survive across runs
+        and are invalidated when either changes. The hash of a font is itself
+        an entry, keyed by its path, size and mtime like LineIndex offsets,
+        so fonts are only read again when they change.
+    """
+
+    directory = os.path.join('cache', 'coverage')
+
+    __entries = {}
+
+    @classmethod
+    def font_hash(cls, font):
+        """
+            Return the SHA-1 of a font file, hashing it only if its path, size
+            or mtime is not indexed yet
+        """
+
+        stat = os.stat(font)
+        path_hash = hashlib.sha1(os.path.abspath(font).encode('utf-8')).hexdigest()[:12]
+        name = 'font-{}.{}.{}.{}'.format(os.path.basename(font), path_hash, stat.st_size, int(stat.st_mtime))
+
+        entry = cls.__load(name)
+        if entry is None:
+            with open(font, 'rb') as f:
+                entry = hashlib.sha1(f.read()).hexdigest()
+            cls.__store(name, entry)
+
+        return entry
+
+    @classmethod
+    def charsets_hash(cls, charsets):
+        """
+            Return the SHA-1 of a {name: [characters]} dictionary
+        """
+
+        return hashlib.sha1(json.dumps(charsets, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def __load(cls, name):
+        if name in cls.__entries:
+            return cls.__entries[name]
+
+        path = os.path.join(cls.directory, name + '.json')
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+        cls.__entries[name] = entry
+
+        return entry
+
+    @classmethod
+    def __store(cls, name, entry):
+        os.makedirs(cls.directory, exist_ok=True)
+
+        with atomic_open(os.path.join(cls.directory, name + '.json'), 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+
+        cls.__entries[name] = entry
+
+    @classmethod
+    def cmap(cls, font):
+        """
+            Return the cmap characters of a font, see cmap_characters
+        """
+
+        name = 'cmap-' + cls.font_hash(font)
+        entry = cls.__load(name)
+        if entry is None:
+            entry = cmap_characters(TTFont(font, fontNumber=0))
+            cls.__store(name, entry)
+
+        return entry
+
+    @classmethod
+    def compute(cls, font, charsets):
+        """
+            Check every character of every charset against the font, keeping
+            the ones that are both mapped and actually draw something
+        """
+
+        ttf = TTFont(font, fontNumber=0)
+        chars = set(cmap_characters(ttf))
+
+        return {
+            charset: [
+                x for x in characters
+                if check_character_in_font(x, ttf) and check_character_in_fontc1(x, font) and x in chars
+            ]
+            for charset, characters in charsets.items()
+        }
+
+    @classmethod
+    def coverage(cls, font, charsets):
+        """
+            Return {name: [characters of the charset the font can render]}
+        """
+
+        name = 'coverage-{}-{}'.format(cls.font_hash(font), cls.charsets_hash(charsets))
+        entry = cls.__load(name)
+        if entry is None:
+            entry = cls.compute(font, charsets)
+            cls.__store(name, entry)
+
+        return entry
+
+    @classmethod
+    def build(cls, fonts, charsets, processes=1):
+        """
+            Compute the missing coverage entries of the fonts, in parallel
+        """
+
+        charsets_hash = cls.charsets_hash(charsets)
+        missing = {}
+        for font in fonts:
+            name = 'coverage-{}-{}'.format(cls.font_hash(font), charsets_hash)
+            if name not in missing and cls.__load(name) is None:
+                missing[name] = font
+
+        if len(missing) == 0:
+            return
+
+        print('Indexing glyph coverage of {} fonts'.format(len(missing)))
+
+        if processes > 1 and len(missing) > 1:
+            with Pool(processes) as p:
+                entries = p.starmap(cls.compute, [(font, charsets) for font in missing.values()])
+        else:
+            entries = [cls.compute(font, charsets) for font in missing.values()]
+
+        for name, entry in zip(missing.keys(), entries):
+            cls.__store(name, entry)
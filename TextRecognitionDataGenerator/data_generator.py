@@ -11,6 +11,12 @@ except ImportError as e:
     print('Missing modules for handwritten text generation.')
 from background_generator import BackgroundGenerator
 from distorsion_generator import DistorsionGenerator
+from shard_writer import ShardWriter
+from binarization import fast_nick_binarize
+from stage_profiler import StageTimer, BACKGROUND_NAMES, DISTORSION_NAMES
+import array_ops
+import io
+import json
 import cv2
 import numpy as np
 from skimage.filters import threshold_niblack, rank
@@ -59,7 +65,99 @@ def nick_binarize(img_list):
 
 class FakeTextDataGenerator(object):
     @classmethod
-    def generate(cls, index, text, font, out_dir, height, extension, skewing_angle, random_skew, blur, random_blur, background_type, distorsion_type, distorsion_orientation, is_handwritten, name_format, text_color=-1, prefix = ""):
+    def seed_sample(cls, seed, index):
+        """
+            Seed the random generators for one sample from (seed, index) alone,
+            so the sample does not depend on which worker draws it or on what
+            that worker generated before
+        """
+
+        # String seeds are hashed with SHA-512, which is stable across processes and runs
+        random.seed('{}-{}'.format(seed, index))
+        np.random.seed(random.getrandbits(32))
+        # The Gaussian noise background draws from OpenCV's own generator
+        cv2.setRNGSeed(random.getrandbits(31))
+
+    @classmethod
+    def generate(cls, index, text, font, out_dir, height, extension, skewing_angle, random_skew, blur, random_blur, background_type, distorsion_type, distorsion_orientation, is_handwritten, name_format, text_color=-1, prefix = "", output_format="files", render_backend="freetype", seed=None, profile=False, pipeline="pil"):
+            """
+                Generate and save one sample. With profile, returns the wall
+                time of each stage tagged with the random branches taken.
+                pipeline is pil (generate_image), array (generate_array) or
+                fused (generate_array with fused_warp).
+            """
+
+            timer = StageTimer(profile)
+
+            if pipeline == 'pil':
+                final_image, tags = cls.generate_image(
+                    index, text, font, height, skewing_angle, random_skew, blur, random_blur, background_type,
+                    distorsion_type, distorsion_orientation, is_handwritten, text_color, render_backend, seed, timer
+                )
+            else:
+                final_image, tags = cls.generate_array(
+                    index, text, font, height, skewing_angle, random_skew, blur, random_blur, background_type,
+                    distorsion_type, distorsion_orientation, is_handwritten, text_color, render_backend, seed, timer,
+                    fused_warp=(pipeline == 'fused')
+                )
+
+            #####################################
+            # Generate name for resulting image #
+            #####################################
+            if name_format == 0:
+                image_name = '{}_{}.{}'.format(text, str(index), extension)
+            elif name_format == 1:
+                image_name = '{}_{}.{}'.format(str(index), text, extension)
+            elif name_format == 2:
+                image_name = '{}.{}'.format(str(index),extension)
+            elif name_format == 3:
+                image_name = '{}_{}.{}'.format(prefix, str(index), extension)
+            else:
+                print('{} is not a valid name format. Using default.'.format(name_format))
+                image_name = '{}_{}.{}'.format(text, str(index), extension)
+
+
+            # Save the image
+            if output_format == 'tar':
+                # Keys must not contain dots, the label travels in its own member instead
+                key = '{:09d}'.format(index)
+                if pipeline != 'pil':
+                    encoded = array_ops.encode(final_image, extension)
+                else:
+                    buffer = io.BytesIO()
+                    final_image.convert('RGB').save(buffer, format=Image.registered_extensions()['.' + extension.lower()])
+                    encoded = buffer.getvalue()
+                ShardWriter.write(
+                    out_dir,
+                    key,
+                    [
+                        (extension, encoded),
+                        ('txt', text.encode('utf-8')),
+                        ('json', json.dumps({'index': index, 'name': image_name, 'text': text, 'font': font}).encode('utf-8')),
+                    ]
+                )
+            elif pipeline != 'pil':
+                with open(os.path.join(out_dir, image_name), 'wb') as f:
+                    f.write(array_ops.encode(final_image, extension))
+            else:
+                final_image.convert('RGB').save(os.path.join(out_dir, image_name))
+            timer.mark('save')
+
+            return timer.record(**tags)
+
+    @classmethod
+    def generate_image(cls, index, text, font, height, skewing_angle, random_skew, blur, random_blur, background_type, distorsion_type, distorsion_orientation, is_handwritten, text_color=-1, render_backend="freetype", seed=None, timer=None):
+            """
+                Render and augment one sample without saving it. Returns the
+                grayscale PIL image and the random branches it took.
+            """
+
+            if seed is not None:
+                cls.seed_sample(seed, index)
+
+            if timer is None:
+                timer = StageTimer(False)
+
             image = None
 
             ##########################
@@ -68,11 +166,13 @@ class FakeTextDataGenerator(object):
             if is_handwritten:
                 image = HandwrittenTextGenerator.generate(text)
             else:
-                image = ComputerTextGenerator.generate(text, font, text_color, height)
+                image = ComputerTextGenerator.generate(text, font, text_color, height, render_backend)
+            timer.mark('render')
 
             random_angle = random.uniform(0-skewing_angle, skewing_angle)
 
             rotated_img = image.rotate(skewing_angle if not random_skew else random_angle, expand=1)
+            timer.mark('rotate')
 
             if (random.randint(0,10) < 3):
                 x = random.randint(1,4)
@@ -85,6 +185,7 @@ class FakeTextDataGenerator(object):
                     kernel = np.ones((x, x), np.uint8)
 
                     rotated_img = Image.fromarray(cv2.morphologyEx(np.array(rotated_img), cv2.MORPH_CLOSE, kernel))
+            timer.mark('morphology')
 
             f = random.uniform(0.9, 1.1)
             if (random.randint(0, 1) == 0):
@@ -97,9 +198,13 @@ class FakeTextDataGenerator(object):
                 else:
                     rotated_img = rotated_img.resize((int(rotated_img.size[0] * f), int(rotated_img.size[1] * f)),
                                                      Image.LANCZOS)
+            timer.mark('resize')
 
+            binarized = False
             if (random.randint(0,30) < 1 and height > 60):
-                rotated_img = Image.fromarray(nick_binarize([np.array(rotated_img)])[0])
+                rotated_img = Image.fromarray(fast_nick_binarize([np.array(rotated_img)])[0])
+                binarized = True
+                timer.mark('binarize')
 
             # if (random.randint(0,10) < 1 and height > 60):
             #     kernel = np.ones((2, 2), np.uint8)
@@ -133,6 +238,8 @@ class FakeTextDataGenerator(object):
                     horizontal=(distorsion_orientation == 1 or distorsion_orientation == 2)
                 )
 
+            timer.mark('distorsion')
+
             new_text_width, new_text_height = distorted_img.size
 
             x = random.randint(1, 10)
@@ -153,6 +260,7 @@ class FakeTextDataGenerator(object):
                 background = BackgroundGenerator.quasicrystal(new_text_height + x, new_text_width + y)
             else:
                 background = BackgroundGenerator.picture(new_text_height + 10, new_text_width + 10)
+            timer.mark('background')
 
             mask = distorted_img.point(lambda x: 0 if x == 255 or x == 0 else 255, '1')
 
@@ -162,6 +270,7 @@ class FakeTextDataGenerator(object):
             else:
                 apply_background = True
                 background.paste(distorted_img, (5, 5), mask=mask)
+            timer.mark('paste')
 
             ##################################
             # Resize image to desired format #
@@ -177,6 +286,7 @@ class FakeTextDataGenerator(object):
                 )
             else:
                 final_image = background
+            timer.mark('blur')
 
             f = random.uniform(0.8, 1.5)
             # if distorsion_type != 3:
@@ -199,25 +309,136 @@ class FakeTextDataGenerator(object):
                 #         final_image = Image.fromarray(cv2.resize(np.array(final_image),
                 #                                                  (int(final_image.size[0] * f),
                 #                                                   int(final_image.size[1] * f))), cv2.INTER_LINEAR)
+            timer.mark('final_resize')
 
             # if (random.randint(0, 10) < 4 and apply_background == False and background_type == 1 and new_text_height > 45):
             #     final_image = Image.fromarray(nick_binarize([np.array(final_image)])[0])
 
-            #####################################
-            # Generate name for resulting image #
-            #####################################
-            if name_format == 0:
-                image_name = '{}_{}.{}'.format(text, str(index), extension)
-            elif name_format == 1:
-                image_name = '{}_{}.{}'.format(str(index), text, extension)
-            elif name_format == 2:
-                image_name = '{}.{}'.format(str(index),extension)
-            elif name_format == 3:
-                image_name = '{}_{}.{}'.format(prefix, str(index), extension)
+            return final_image, {
+                'background': BACKGROUND_NAMES[background_type],
+                'distorsion': DISTORSION_NAMES[distorsion_type],
+                'binarized': binarized,
+            }
+
+    @classmethod
+    def generate_array(cls, index, text, font, height, skewing_angle, random_skew, blur, random_blur, background_type, distorsion_type, distorsion_orientation, is_handwritten, text_color=-1, render_backend="freetype", seed=None, timer=None, fused_warp=False):
+            """
+                Same as generate_image, with the same random draws, on a single
+                channel uint8 array from the rendered text to the final image.
+                Morphology, blur and the paste work in place, PIL is only used
+                to render the text. Returns the array and the random branches
+                it took.
+
+                With fused_warp, rotation, scaling and distorsion are applied
+                as one warp of the text (see array_ops.fused_warp) instead of
+                three resamplings, morphology then comes before the rotation
+                and binarization after the distorsion.
+            """
+
+            if seed is not None:
+                cls.seed_sample(seed, index)
+
+            if timer is None:
+                timer = StageTimer(False)
+
+            if is_handwritten:
+                img = np.array(HandwrittenTextGenerator.generate(text).convert('L'))
             else:
-                print('{} is not a valid name format. Using default.'.format(name_format))
-                image_name = '{}_{}.{}'.format(text, str(index), extension)
+                img = ComputerTextGenerator.generate_array(text, font, text_color, height, render_backend)
+            timer.mark('render')
 
+            random_angle = random.uniform(0-skewing_angle, skewing_angle)
+            angle = skewing_angle if not random_skew else random_angle
 
-            # Save the image
-            final_image.convert('RGB').save(os.path.join(out_dir, image_name))
\ No newline at end of file
+            if not fused_warp:
+                img = array_ops.rotate_expand(img, angle)
+                timer.mark('rotate')
+
+            if (random.randint(0,10) < 3):
+                x = random.randint(1,4)
+                cv2.erode(img, np.ones((x, x), np.uint8), dst=img, iterations=1)
+            else:
+                if (random.randint(0,10) < 1 and height > 45):
+                    x = random.randint(1, 4)
+                    cv2.morphologyEx(img, cv2.MORPH_CLOSE, np.ones((x, x), np.uint8), dst=img)
+            timer.mark('morphology')
+
+            f = random.uniform(0.9, 1.1)
+            if (random.randint(0, 1) == 0):
+                resample = 'antialias'
+            else:
+                if (random.randint(0, 1) == 0):
+                    resample = 'bilinear'
+                else:
+                    resample = 'lanczos'
+
+            binarize = random.randint(0,30) < 1 and height > 60
+            distorsion_type = random.choice([0,1,2])
+            vertical = (distorsion_orientation == 0 or distorsion_orientation == 2)
+            horizontal = (distorsion_orientation == 1 or distorsion_orientation == 2)
+
+            if fused_warp:
+                distorsion = None
+                if distorsion_type != 0:
+                    distorsion = (vertical, horizontal, 2, DistorsionGenerator.offset_function(distorsion_type, 2))
+                img = array_ops.fused_warp(img, angle, f, distorsion)
+                timer.mark('warp')
+
+                if binarize:
+                    img = fast_nick_binarize([img])[0]
+                    timer.mark('binarize')
+            else:
+                img = array_ops.resize(img, f, resample)
+                timer.mark('resize')
+
+                if binarize:
+                    img = fast_nick_binarize([img])[0]
+                    timer.mark('binarize')
+
+                if distorsion_type == 1:
+                    img = DistorsionGenerator.sin(img, vertical=vertical, horizontal=horizontal, max_offset=2)
+                elif distorsion_type == 2:
+                    img = DistorsionGenerator.cos(img, vertical=vertical, horizontal=horizontal, max_offset=2)
+                timer.mark('distorsion')
+
+            new_text_height, new_text_width = img.shape
+
+            x = random.randint(1, 10)
+            y = random.randint(1, 10)
+            background_type = random.randint(0, 3)
+
+            if background_type == 0:
+                background = BackgroundGenerator.gaussian_noise_array(new_text_height + x, new_text_width + y)
+            elif background_type == 1:
+                background = BackgroundGenerator.plain_white_array(new_text_height + x, new_text_width + y)
+            elif background_type == 2:
+                background = BackgroundGenerator.quasicrystal_array(new_text_height + x, new_text_width + y)
+            else:
+                background = BackgroundGenerator.picture_array(new_text_height + 10, new_text_width + 10)
+            timer.mark('background')
+
+            if (random.randint(0,10) < 1):
+                background = img
+            else:
+                array_ops.paste_masked(background, img, 5, 5)
+            timer.mark('paste')
+
+            if distorsion_type != 3 and background_type != 2 and new_text_height > 45:
+                array_ops.gaussian_blur(background, blur if not random_blur else random.randint(0, blur))
+            timer.mark('blur')
+
+            f = random.uniform(0.8, 1.5)
+            if (random.randint(0,1) == 0):
+                final_image = array_ops.resize(background, f, 'antialias')
+            else:
+                if (random.randint(0, 1) == 0):
+                    final_image = array_ops.resize(background, f, 'bilinear')
+                else:
+                    final_image = array_ops.resize(background, f, 'lanczos')
+            timer.mark('final_resize')
+
+            return final_image, {
+                'background': BACKGROUND_NAMES[background_type],
+                'distorsion': DISTORSION_NAMES[distorsion_type],
+                'binarized': binarize,
+            }
\ No newline at end of file
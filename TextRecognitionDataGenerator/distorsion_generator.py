@@ -1,5 +1,4 @@
 import cv2
-import math
 import os
 import random
 import numpy as np
@@ -7,52 +6,104 @@ import numpy as np
 from PIL import Image, ImageFont, ImageDraw, ImageFilter
 
 class DistorsionGenerator(object):
+    @classmethod
+    def distorsion_indices(cls, height, width, vertical, horizontal, max_offset, func):
+        """
+            Return, for every pixel of the distorted image, the (row, column)
+            it is read from in the height x width source, and whether that
+            source pixel exists. See apply_func_distorsion.
+        """
+
+        vertical_offsets = np.asarray(func(np.arange(width)), dtype=np.intp)
+        horizontal_offsets = np.asarray(
+            func(
+                np.arange(
+                    height + (
+                        (vertical_offsets.max() - min(vertical_offsets.min(), 0)) if vertical else 0
+                    )
+                )
+            ),
+            dtype=np.intp
+        )
+
+        new_height = height + (2 * max_offset if vertical else 0)
+        new_width = width + (2 * max_offset if horizontal else 0)
+
+        rows = np.arange(new_height)[:, None]
+        src_cols = np.arange(new_width)[None, :]
+        valid = np.ones((new_height, new_width), dtype=bool)
+
+        if horizontal:
+            # Rows past the horizontal offsets were never written to
+            row_offsets = np.zeros(new_height, dtype=np.intp)
+            row_count = min(len(horizontal_offsets), new_height)
+            row_offsets[:row_count] = horizontal_offsets[:row_count]
+            valid &= rows < len(horizontal_offsets)
+            src_cols = src_cols - max_offset - row_offsets[:, None]
+            valid &= (src_cols >= 0) & (src_cols < width)
+            src_cols = np.clip(src_cols, 0, width - 1)
+            if vertical:
+                column_offsets = vertical_offsets[src_cols]
+        else:
+            # Columns stay in place, their offsets broadcast instead of being gathered
+            column_offsets = vertical_offsets[None, :]
+
+        src_cols = np.broadcast_to(src_cols, (new_height, new_width))
+
+        if vertical:
+            src_rows = rows - max_offset - column_offsets
+        else:
+            src_rows = np.broadcast_to(rows, (new_height, new_width))
+        valid &= (src_rows >= 0) & (src_rows < height)
+        src_rows = np.clip(src_rows, 0, height - 1)
+
+        return src_rows, src_cols, valid
+
+    @classmethod
+    def offset_function(cls, distorsion_type, max_offset):
+        """
+            Return the offset function of a distorsion type (1 sine, 2 cosine, 3 random)
+        """
+
+        if distorsion_type == 1:
+            return lambda x: np.trunc(np.sin(np.radians(x)) * max_offset)
+        if distorsion_type == 2:
+            return lambda x: np.trunc(np.cos(np.radians(x)) * max_offset)
+
+        # Seeded from the random module so that random.seed() still drives the offsets
+        rng = np.random.RandomState(random.getrandbits(32))
+        return lambda x: rng.randint(0, max_offset + 1, len(x))
+
     @classmethod
     def apply_func_distorsion(cls, image, vertical, horizontal, max_offset, func):
         """
+            Shift every column (vertical) and/or every row (horizontal) of the
+            image by func(index) pixels. func receives an array of indices and
+            returns an array of integer offsets.
+
+            The shifts are computed as a single gather over a uint8 array,
+            uncovered pixels are left black like the historical implementation.
+            image is a PIL image or a single channel uint8 array, the result
+            is of the same kind.
         """
 
         # Nothing to do!
         if not vertical and not horizontal:
             return image
 
-        rgb_image = image.convert('RGB')
-        
-        img_arr = np.array(rgb_image)
+        is_array = isinstance(image, np.ndarray)
+        if is_array:
+            img_arr = image
+        else:
+            img_arr = np.array(image if image.mode == 'L' else image.convert('L'))
+        height, width = img_arr.shape
 
-        vertical_offsets = [func(i) for i in range(img_arr.shape[1])]
-        horizontal_offsets = [
-            func(i)
-            for i in range(
-                img_arr.shape[0] + (
-                    (max(vertical_offsets) - min(min(vertical_offsets), 0)) if vertical else 0
-                )
-            )
-        ]
-
-        new_img_arr = np.zeros((
-                          img_arr.shape[0] + (2 * max_offset if vertical else 0),
-                          img_arr.shape[1] + (2 * max_offset if horizontal else 0),
-                          3
-                      ))
-
-        new_img_arr_copy = np.copy(new_img_arr)
-        
-        if vertical:
-            column_height = img_arr.shape[0]
-            for i, o in enumerate(vertical_offsets):
-                column_pos = (i + max_offset) if horizontal else i
-                new_img_arr[max_offset+o:column_height+max_offset+o, column_pos, :] = img_arr[:, i, :]
+        src_rows, src_cols, valid = cls.distorsion_indices(height, width, vertical, horizontal, max_offset, func)
 
-        if horizontal:
-            row_width = img_arr.shape[1]
-            for i, o in enumerate(horizontal_offsets):
-                if vertical:
-                    new_img_arr_copy[i, max_offset+o:row_width+max_offset+o,:] = new_img_arr[i, max_offset:row_width+max_offset, :]
-                else:
-                    new_img_arr[i, max_offset+o:row_width+max_offset+o,:] = img_arr[i, :, :]
+        new_img_arr = img_arr[src_rows, src_cols]
+        new_img_arr[~valid] = 0
 
-        return Image.fromarray(np.uint8(new_img_arr_copy if horizontal and vertical else new_img_arr)).convert('L')
+        return new_img_arr if is_array else Image.fromarray(new_img_arr, 'L')
 
     @classmethod
     def sin(cls, image, vertical=False, horizontal=False, max_offset=10):
@@ -60,7 +111,7 @@ class DistorsionGenerator(object):
             Apply a sine distorsion on one or both of the specified axis
         """
 
-        return cls.apply_func_distorsion(image, vertical, horizontal, max_offset, (lambda x: int(math.sin(math.radians(x)) * max_offset)))
+        return cls.apply_func_distorsion(image, vertical, horizontal, max_offset, cls.offset_function(1, max_offset))
 
     @classmethod
     def cos(cls, image, vertical=False, horizontal=False, max_offset=10):
@@ -68,7 +119,7 @@ class DistorsionGenerator(object):
             Apply a cosine distorsion on one or both of the specified axis
         """
 
-        return cls.apply_func_distorsion(image, vertical, horizontal, max_offset, (lambda x: int(math.cos(math.radians(x)) * max_offset)))
+        return cls.apply_func_distorsion(image, vertical, horizontal, max_offset, cls.offset_function(2, max_offset))
 
     @classmethod
     def random(cls, image, vertical=False, horizontal=False, max_offset=3):
@@ -76,5 +127,4 @@ class DistorsionGenerator(object):
             Apply a random distorsion on one or both of the specified axis
         """
 
-        return cls.apply_func_distorsion(image, vertical, horizontal, max_offset, (lambda x: random.randint(0, max_offset)))
-
+        return cls.apply_func_distorsion(image, vertical, horizontal, max_offset, cls.offset_function(3, max_offset))
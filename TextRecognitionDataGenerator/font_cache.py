@@ -0,0 +1,91 @@
+import os
+from collections import OrderedDict
+
+from PIL import ImageFont
+
+class FontCache(object):
+    """
+        Bounded per-process LRU cache of FreeType fonts keyed on (path, size)
+    """
+
+    max_size = 4096
+    hits = 0
+    misses = 0
+
+    __fonts = OrderedDict()
+    __pid = None
+
+    @classmethod
+    def __check_process(cls):
+        """
+            FreeType faces keep their font file open, so a cache inherited
+            through fork() would share file offsets with the parent. Start over
+            whenever we find ourselves in a new process.
+        """
+
+        pid = os.getpid()
+        if cls.__pid != pid:
+            cls.__fonts = OrderedDict()
+            cls.__pid = pid
+            cls.hits = 0
+            cls.misses = 0
+
+    @classmethod
+    def get(cls, font, size):
+        """
+            Return the ImageFont for (font, size), loading it on a miss
+        """
+
+        cls.__check_process()
+
+        key = (font, size)
+        image_font = cls.__fonts.get(key)
+        if image_font is not None:
+            cls.__fonts.move_to_end(key)
+            cls.hits += 1
+            return image_font
+
+        cls.misses += 1
+        image_font = ImageFont.truetype(font=font, size=size)
+        cls.__fonts[key] = image_font
+        while len(cls.__fonts) > cls.max_size:
+            cls.__fonts.popitem(last=False)
+
+        return image_font
+
+    @classmethod
+    def configure(cls, max_size):
+        """
+            Change the maximum number of fonts kept, evicting the oldest ones if needed
+        """
+
+        if max_size < 1:
+            raise Exception('Font cache size must be at least 1')
+
+        cls.__check_process()
+        cls.max_size = max_size
+        while len(cls.__fonts) > cls.max_size:
+            cls.__fonts.popitem(last=False)
+
+    @classmethod
+    def clear(cls):
+        """
+            Drop every cached font and reset the counters
+        """
+
+        cls.__pid = None
+        cls.__check_process()
+
+    @classmethod
+    def stats(cls):
+        """
+            Return the current size, capacity and hit/miss counters of the cache
+        """
+
+        cls.__check_process()
+        return {
+            'size': len(cls.__fonts),
+            'max_size': cls.max_size,
+            'hits': cls.hits,
+            'misses': cls.misses,
+        }
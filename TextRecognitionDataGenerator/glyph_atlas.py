@@ -0,0 +1,125 @@
+import os
+import numpy as np
+from collections import OrderedDict
+
+from font_cache import FontCache
+
+class GlyphAtlas(object):
+    """
+        Pre-rasterized glyphs of one (font, size) pair.
+
+        Every glyph is rendered once by FreeType and kept as an 8-bit coverage
+        mask together with its offset and advance width, pair kerning is
+        looked up once per pair. Strings are then composed by blitting those
+        masks into a NumPy canvas, which skips the per-string layout and
+        rasterization. There is no complex shaping, so this is only meant for
+        character-level text (random sequences, CJK, ...).
+    """
+
+    max_atlases = 256
+
+    __atlases = OrderedDict()
+    __pid = None
+
+    def __init__(self, font, size):
+        self.image_font = FontCache.get(font, size)
+        self.glyphs = {}
+        self.kerning = {}
+
+    @classmethod
+    def get(cls, font, size):
+        """
+            Return the atlas of (font, size), creating it on first use
+        """
+
+        pid = os.getpid()
+        if cls.__pid != pid:
+            cls.__atlases = OrderedDict()
+            cls.__pid = pid
+
+        key = (font, size)
+        atlas = cls.__atlases.get(key)
+        if atlas is not None:
+            cls.__atlases.move_to_end(key)
+            return atlas
+
+        atlas = cls(font, size)
+        cls.__atlases[key] = atlas
+        while len(cls.__atlases) > cls.max_atlases:
+            cls.__atlases.popitem(last=False)
+
+        return atlas
+
+    def glyph(self, char):
+        """
+            Return (mask, x offset, y offset, advance) of a character
+        """
+
+        glyph = self.glyphs.get(char)
+        if glyph is None:
+            mask, offset = self.image_font.getmask2(char, mode='L')
+            glyph = (
+                np.frombuffer(bytes(mask), dtype=np.uint8).reshape(mask.size[1], mask.size[0]),
+                offset[0],
+                offset[1],
+                self.image_font.getlength(char)
+            )
+            self.glyphs[char] = glyph
+        return glyph
+
+    def kern(self, left, right):
+        """
+            Return the kerning adjustment between two characters, in pixels
+        """
+
+        pair = left + right
+        adjustment = self.kerning.get(pair)
+        if adjustment is None:
+            adjustment = self.image_font.getlength(pair) - self.glyph(left)[3] - self.glyph(right)[3]
+            self.kerning[pair] = adjustment
+        return adjustment
+
+    def warm(self, chars):
+        """
+            Rasterize a set of characters ahead of time
+        """
+
+        for char in chars:
+            self.glyph(char)
+
+    def render(self, text, fill):
+        """
+            Compose text into a white uint8 canvas with the given gray level
+        """
+
+        placements = []
+        pen = 0.0
+        width = 0
+        height = 0
+        previous = None
+        for char in text:
+            if previous is not None:
+                pen += self.kern(previous, char)
+            mask, x_offset, y_offset, advance = self.glyph(char)
+            x = int(round(pen)) + x_offset
+            placements.append((mask, x, y_offset))
+            width = max(width, x + mask.shape[1])
+            height = max(height, y_offset + mask.shape[0])
+            pen += advance
+            previous = char
+        width = max(width, int(round(pen)))
+
+        canvas = np.full((height, width), 255, dtype=np.uint8)
+        for mask, x, y in placements:
+            # Glyphs reaching left of (or above) the origin are clipped like FreeType does
+            if x < 0:
+                mask, x = mask[:, -x:], 0
+            if y < 0:
+                mask, y = mask[-y:, :], 0
+            if mask.size == 0:
+                continue
+            region = canvas[y:y + mask.shape[0], x:x + mask.shape[1]].astype(np.int32)
+            alpha = mask.astype(np.int32)
+            canvas[y:y + mask.shape[0], x:x + mask.shape[1]] = (region * (255 - alpha) + fill * alpha + 127) // 255
+
+        return canvas
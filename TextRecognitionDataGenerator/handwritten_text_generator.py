@@ -1,26 +1,168 @@
 import os
 import pickle
-import argparse
+import cv2
 import numpy as np
 import tensorflow as tf
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-import matplotlib.mlab as mlab
-import seaborn
 from PIL import Image
 from collections import namedtuple
 
+class HandwritingModel(object):
+    """
+        Per-process holder of the handwriting graph, its session and the named
+        tensors used for sampling. A TensorFlow session does not survive fork(),
+        so the model is reloaded whenever it is used from a new process.
+    """
+
+    model_dir = 'handwritten_model'
+    # How many words are sampled together, the recurrent state is sized for it when loading
+    batch_size = 8
+    fields = ['coordinates', 'sequence', 'bias', 'e', 'pi', 'mu1', 'mu2', 'std1', 'std2',
+              'rho', 'window', 'kappa', 'phi', 'finish', 'zero_states']
+
+    __pid = None
+    __session = None
+    __params = None
+    __translation = None
+
+    @classmethod
+    def __resize_state(cls, graph_def, batch_size):
+        """
+            Make room for batch_size sequences in the recurrent state of the
+            sampling network. It lives in (1, n) variables, zeroed by constants
+            of the same shape, and the steps are stacked with that shape too.
+            Everything else takes its batch from the inputs.
+        """
+
+        # Zero states are filled to the shape concat([batch], [n])
+        batch_dims = set(
+            node.input[0] for node in graph_def.node
+            if node.name.startswith('model_1/rnn/RNNModelZeroState/') and node.op == 'ConcatV2'
+        )
+
+        for node in graph_def.node:
+            # Recorded shapes would contradict the new ones, they are inferred again on import
+            if '_output_shapes' in node.attr:
+                del node.attr['_output_shapes']
+
+            if node.name.startswith('model_1/rnn_1/') and node.op == 'TensorArrayGatherV3':
+                # Outputs of the steps are stacked to (steps, batch, n)
+                node.attr['element_shape'].shape.dim[0].size = batch_size
+            elif not node.name.startswith('model_1/rnn/'):
+                continue
+            elif node.op == 'VariableV2':
+                node.attr['shape'].shape.dim[0].size = batch_size
+            elif node.op == 'Const':
+                value = tf.make_ndarray(node.attr['value'].tensor)
+                if value.ndim == 2 and value.shape[0] == 1:
+                    value = np.zeros((batch_size, value.shape[1]), dtype=value.dtype)
+                elif node.name in batch_dims:
+                    value = np.array([batch_size], dtype=value.dtype)
+                else:
+                    continue
+                node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(value))
+
+    @classmethod
+    def __finish(cls, graph, sequence):
+        """
+            Build the finish signal of every sequence of the batch: the attention
+            peaks on the zero row closing the sequence rather than on any of its
+            characters. The graph only looks at the last row of the padded sequences.
+        """
+
+        # State reached by this step, read from the loop rather than from the variables
+        h = graph.get_tensor_by_name('model_1/rnn_1/while/Exit_3:0')
+        kappa = graph.get_tensor_by_name('model_1/rnn_1/while/Exit_9:0')[:, :, None]
+
+        def window(name):
+            kernel = graph.get_tensor_by_name('model/rnn/rnn_model/window/{}/kernel/read:0'.format(name))
+            bias = graph.get_tensor_by_name('model/rnn/rnn_model/window/{}/bias/read:0'.format(name))
+            return tf.exp(tf.matmul(h, kernel) + bias)[:, :, None]
+
+        u = tf.cast(tf.range(tf.shape(sequence)[1]), tf.float32)
+        phi = tf.reduce_sum(window('alpha') * tf.exp(-window('beta') * tf.square(kappa - u)), axis=1)
+
+        # Characters are one-hot rows, the closing and padding rows are zero
+        length = tf.reduce_sum(tf.reduce_max(sequence, axis=2), axis=1)
+        last = tf.reduce_sum(phi * tf.cast(tf.equal(u, length[:, None]), tf.float32), axis=1)
+        before = tf.reduce_max(phi * tf.cast(u < length[:, None], tf.float32), axis=1)
+
+        return tf.cast(last > before, tf.float32)[:, None]
+
+    @classmethod
+    def load(cls):
+        """
+            Load the translation table, graph and checkpoint unless this process already did
+        """
+
+        if cls.__pid == os.getpid():
+            return
+
+        with open(os.path.join(cls.model_dir, 'translation.pkl'), 'rb') as file:
+            translation = pickle.load(file)
+
+        meta_graph = tf.MetaGraphDef()
+        with open(os.path.join(cls.model_dir, 'model-29.meta'), 'rb') as file:
+            meta_graph.ParseFromString(file.read())
+        # The checkpoint was exported to sample one sequence at a time
+        cls.__resize_state(meta_graph.graph_def, cls.batch_size)
+
+        config = tf.ConfigProto(
+            device_count={'GPU': 0}
+        )
+        graph = tf.Graph()
+        with graph.as_default():
+            sess = tf.Session(graph=graph, config=config)
+            tf.train.import_meta_graph(meta_graph)
+            # The resized state is not restored, zero_states sets it before every batch
+            weights = [v for v in tf.global_variables() if not v.op.name.startswith('model_1/rnn/')]
+            tf.train.Saver(weights).restore(sess, os.path.join(cls.model_dir, 'model-29'))
+            params = namedtuple('Params', cls.fields)(
+                *[tf.get_collection(name)[0] for name in cls.fields]
+            )
+            params = params._replace(finish=cls.__finish(graph, params.sequence))
+        graph.finalize()
+
+        cls.__session = sess
+        cls.__params = params
+        cls.__translation = translation
+        cls.__pid = os.getpid()
+
+    @classmethod
+    def get(cls):
+        """
+            Return (session, params, translation), loading the model on first use
+        """
+
+        cls.load()
+        return cls.__session, cls.__params, cls.__translation
+
 class HandwrittenTextGenerator(object):
+    # Every word is stretched to fit this box, like the matplotlib axes used to do
+    word_width = 496
+    word_height = 369
+    stroke_width = 2
+    stroke_color = 8
+
     @classmethod
-    def __sample(cls, e, mu1, mu2, std1, std2, rho):
-        cov = np.array([[std1 * std1, std1 * std2 * rho],
-                        [std1 * std2 * rho, std2 * std2]])
-        mean = np.array([mu1, mu2])
+    def __sample(cls, e, pi, mu1, mu2, std1, std2, rho):
+        """
+            Draw one point per sequence from its bivariate Gaussian mixture,
+            vectorized over the batch. Returns the points and the chosen components.
+        """
+
+        batch = np.arange(pi.shape[0])
+
+        # Inverse CDF over the mixture weights of each sequence
+        g = (np.cumsum(pi, axis=1) < np.random.random((pi.shape[0], 1))).sum(axis=1)
+        g = np.minimum(g, pi.shape[1] - 1)
 
-        x, y = np.random.multivariate_normal(mean, cov)
-        end = np.random.binomial(1, e)
-        return np.array([x, y, end])
+        n1, n2 = np.random.standard_normal((2, pi.shape[0]))
+        r = rho[batch, g]
+        x = mu1[batch, g] + std1[batch, g] * n1
+        y = mu2[batch, g] + std2[batch, g] * (r * n1 + np.sqrt(1 - r * r) * n2)
+        end = np.random.binomial(1, e[:, 0])
 
+        return np.stack([x, y, end], axis=1), g
 
     @classmethod
     def __split_strokes(cls, points):
@@ -41,63 +183,91 @@ class HandwrittenTextGenerator(object):
 
 
     @classmethod
-    def __sample_text(cls, sess, args_text, translation):
-        # Original creator said it helps (https://github.com/Grzego/handwriting-generation/issues/3)
-        args_text += ' '
+    def __sample_texts(cls, sess, vs, texts, translation):
+        """
+            Sample the strokes of up to HandwritingModel.batch_size texts together
+            along the batch dimension, one sess.run per time step. Texts are
+            padded with zero rows, which the attention window reads as nothing,
+            and every text stops recording on its own finish signal.
+        """
 
-        fields = ['coordinates', 'sequence', 'bias', 'e', 'pi', 'mu1', 'mu2', 'std1', 'std2',
-                  'rho', 'window', 'kappa', 'phi', 'finish', 'zero_states']
-        vs = namedtuple('Params', fields)(
-            *[tf.get_collection(name)[0] for name in fields]
-        )
+        # Original creator said it helps (https://github.com/Grzego/handwriting-generation/issues/3)
+        texts = [t + ' ' for t in texts]
 
-        text = np.array([translation.get(c, 0) for c in args_text])
-        sequence = np.eye(len(translation), dtype=np.float32)[text]
-        sequence = np.expand_dims(np.concatenate([sequence, np.zeros((1, len(translation)))]), axis=0)
+        # The state of the model holds a full batch, unused rows stay empty
+        batch_size = HandwritingModel.batch_size
+        sequence = np.zeros((batch_size, max(len(t) for t in texts) + 1, len(translation)), dtype=np.float32)
+        for b, t in enumerate(texts):
+            sequence[b, np.arange(len(t)), [translation.get(c, 0) for c in t]] = 1.
+        limits = np.array([60 * len(t) for t in texts] + [0] * (batch_size - len(texts)))
 
-        coord = np.array([0., 0., 1.])
-        coords = [coord]
+        coord = np.tile(np.array([0., 0., 1.]), (batch_size, 1))
+        coords = [[c] for c in coord[:len(texts)]]
+        stroke_data = [[] for _ in texts]
+        running = limits > 0
 
-        phi_data, window_data, kappa_data, stroke_data = [], [], [], []
         sess.run(vs.zero_states)
-        for s in range(1, 60 * len(args_text) + 1):
-            e, pi, mu1, mu2, std1, std2, rho, \
-            finish, phi, window, kappa = sess.run([vs.e, vs.pi, vs.mu1, vs.mu2,
-                                                   vs.std1, vs.std2, vs.rho, vs.finish,
-                                                   vs.phi, vs.window, vs.kappa],
-                                                  feed_dict={
-                                                      vs.coordinates: coord[None, None, ...],
-                                                      vs.sequence: sequence,
-                                                      vs.bias: 1.
-                                                  })
-            phi_data += [phi[0, :]]
-            window_data += [window[0, :]]
-            kappa_data += [kappa[0, :]]
-            # ---
-            g = np.random.choice(np.arange(pi.shape[1]), p=pi[0])
-            coord = cls.__sample(e[0, 0], mu1[0, g], mu2[0, g],
-                           std1[0, g], std2[0, g], rho[0, g])
-            coords += [coord]
-            stroke_data += [[mu1[0, g], mu2[0, g], std1[0, g], std2[0, g], rho[0, g], coord[2]]]
-
-            if finish[0, 0] > 0.8:
+        for s in range(1, limits.max() + 1):
+            e, pi, mu1, mu2, std1, std2, rho, finish = sess.run([vs.e, vs.pi, vs.mu1, vs.mu2,
+                                                                 vs.std1, vs.std2, vs.rho, vs.finish],
+                                                                feed_dict={
+                                                                    vs.coordinates: coord[:, None, :],
+                                                                    vs.sequence: sequence,
+                                                                    vs.bias: 1.
+                                                                })
+            coord, g = cls.__sample(e, pi, mu1, mu2, std1, std2, rho)
+
+            for b in np.nonzero(running)[0]:
+                coords[b] += [coord[b]]
+                stroke_data[b] += [[mu1[b, g[b]], mu2[b, g[b]], std1[b, g[b]], std2[b, g[b]], rho[b, g[b]], coord[b, 2]]]
+
+            running &= (finish[:, 0] <= 0.8) & (s < limits)
+            if not running.any():
                 break
 
-        coords = np.array(coords)
-        coords[-1, 2] = 1.
+        samples = []
+        for b in range(len(texts)):
+            sample_coords = np.array(coords[b])
+            sample_coords[-1, 2] = 1.
+            samples.append((stroke_data[b], sample_coords))
 
-        return phi_data, window_data, kappa_data, stroke_data, coords
+        return samples
 
     @classmethod
-    def __crop_white_borders(cls, image):
-        image_data = np.asarray(image)
-        non_empty_columns = np.where(image_data.min(axis=0)<255)[0]
-        non_empty_rows = np.where(image_data.min(axis=1)<255)[0]
-        cropBox = (min(non_empty_rows), max(non_empty_rows), min(non_empty_columns), max(non_empty_columns))
-
-        image_data_new = image_data[cropBox[0]:cropBox[1]+1, cropBox[2]:cropBox[3]+1]
-
-        return Image.fromarray(image_data_new)
+    def __rasterize_strokes(cls, strokes, stroke_width=None):
+        """
+            Draw the stroke polylines straight into an anti-aliased uint8 array
+            sized to their bounding box, once stretched to the word box, plus
+            room for the stroke width
+        """
+
+        stroke_width = cls.stroke_width if stroke_width is None else stroke_width
+
+        points = np.concatenate(strokes)
+        points[:, 1] = -points[:, 1]
+        low = points.min(axis=0)
+        extent = points.max(axis=0) - low
+
+        # Anti-aliased edges reach half the width and a pixel past the centre line
+        pad = stroke_width // 2 + 1
+        box = np.array([cls.word_width - 1 - 2 * pad, cls.word_height - 1 - 2 * pad])
+        # A flat word (a dash, a dot) stays flat instead of being stretched
+        scale = np.where(extent > 0, box / np.where(extent > 0, extent, 1), 0)
+        width, height = np.round(extent * scale).astype(int) + 1 + 2 * pad
+
+        # Subpixel precision through cv2's fixed-point shift
+        shift = 4
+        polylines = []
+        for stroke in strokes:
+            xy = np.array(stroke, dtype=np.float64)
+            xy[:, 1] = -xy[:, 1]
+            xy = ((xy - low) * scale + pad) * (1 << shift)
+            polylines.append(np.round(xy).astype(np.int32).reshape(-1, 1, 2))
+
+        canvas = np.full((height, width), 255, dtype=np.uint8)
+        cv2.polylines(canvas, polylines, False, cls.stroke_color, stroke_width, cv2.LINE_AA, shift)
+
+        return canvas
 
     @classmethod
     def __join_images(cls, images):
@@ -116,39 +286,35 @@ class HandwrittenTextGenerator(object):
         return compound_image
 
     @classmethod
-    def generate(cls, text):
-        with open(os.path.join('handwritten_model', 'translation.pkl'), 'rb') as file:
-            translation = pickle.load(file)
-
-        config = tf.ConfigProto(
-            device_count={'GPU': 0}
-        )
-        tf.reset_default_graph()
-        with tf.Session(config=config) as sess:
-            saver = tf.train.import_meta_graph('handwritten_model/model-29.meta')
-            saver.restore(sess, 'handwritten_model/model-29')
-            images = []
-            for word in text.split(' '):
-                phi_data, window_data, kappa_data, stroke_data, coords = cls.__sample_text(sess, word, translation)
+    def warm_up(cls):
+        """
+            Load the model in the current process, meant to be used as a Pool initializer
+        """
 
-                strokes = np.array(stroke_data)
-                strokes[:, :2] = np.cumsum(strokes[:, :2], axis=0)
-                minx, maxx = np.min(strokes[:, 0]), np.max(strokes[:, 0])
-                miny, maxy = np.min(strokes[:, 1]), np.max(strokes[:, 1])
+        sess, vs, _ = HandwritingModel.get()
+        sess.run(vs.zero_states)
 
-                fig, ax = plt.subplots(1, 1)
-                fig.patch.set_visible(False)
-                ax.axis('off')
+    @classmethod
+    def generate(cls, text, stroke_width=None):
+        """
+            Write text by hand, stroke_width defaults to the class setting
+        """
 
-                for i, stroke in enumerate(cls.__split_strokes(cls.__cumsum(np.array(coords)))):
-                    plt.plot(stroke[:, 0], -stroke[:, 1], color='#080808')
+        sess, vs, translation = HandwritingModel.get()
 
-                canvas = plt.get_current_fig_manager().canvas
-                canvas.draw()
+        words = text.split(' ')
 
-                image = Image.frombytes('RGB', canvas.get_width_height(), canvas.tostring_rgb()).convert('L')
-                images.append(cls.__crop_white_borders(image))
+        # Words of close lengths are sampled together, a batch runs as long as its longest word
+        samples = [None] * len(words)
+        indices = sorted(range(len(words)), key=lambda i: len(words[i]))
+        for b in range(0, len(indices), HandwritingModel.batch_size):
+            batch = indices[b:b + HandwritingModel.batch_size]
+            for i, sample in zip(batch, cls.__sample_texts(sess, vs, [words[i] for i in batch], translation)):
+                samples[i] = sample
 
-                plt.close()
+        images = []
+        for _, coords in samples:
+            image = cls.__rasterize_strokes(cls.__split_strokes(cls.__cumsum(np.array(coords))), stroke_width)
+            images.append(Image.fromarray(image))
 
-            return cls.__join_images(images)
+        return cls.__join_images(images)
@@ -0,0 +1,111 @@
+import os
+import mmap
+import random
+import hashlib
+import numpy as np
+
+from atomic_file import atomic_open
+
+class LineIndex(object):
+    """
+        Persistent line-offset index over a text file, giving random access to
+        its lines through mmap without ever loading the file.
+
+        The offsets are built once by streaming the file and stored in
+        directory, keyed by the file path, size and mtime.
+    """
+
+    directory = os.path.join('cache', 'lines')
+    block_size = 16 * 1024 * 1024
+
+    def __init__(self, filename, offsets_path):
+        self.offsets = np.load(offsets_path, mmap_mode='r')
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        """
+            Return a line, without its line break
+        """
+
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('LineIndex index out of range')
+        return self.data[int(self.offsets[index]):int(self.offsets[index + 1])].decode('utf-8', errors='ignore').rstrip('\r\n')
+
+    def iterate(self, mode='sequential'):
+        """
+            Endlessly yield lines. sequential cycles through the file in order,
+            uniform draws every line independently and shuffle goes through a
+            new random permutation of the file each pass (no line repeats
+            within a pass)
+        """
+
+        # Seeded from the random module so that random.seed() still drives the sampling
+        rng = np.random.default_rng(random.getrandbits(64))
+        line_count = len(self)
+
+        while True:
+            if mode == 'sequential':
+                indices = range(line_count)
+            elif mode == 'uniform':
+                indices = rng.integers(0, line_count, 4096).tolist()
+            elif mode == 'shuffle':
+                # Shuffled in place as a compact array, a Python int per line would not fit large files
+                indices = np.arange(line_count, dtype=np.int32 if line_count < 2 ** 31 else np.int64)
+                rng.shuffle(indices)
+            else:
+                raise Exception('{} is not a valid input mode'.format(mode))
+
+            for index in indices:
+                yield self[index]
+
+    @classmethod
+    def build(cls, filename, offsets_path):
+        """
+            Stream the file once and store the offset of every line start (plus the end of the file)
+        """
+
+        offsets = [np.zeros(1, dtype=np.int64)]
+        position = 0
+        with open(filename, 'rb') as f:
+            while True:
+                block = f.read(cls.block_size)
+                if not block:
+                    break
+                offsets.append(np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n')).astype(np.int64) + position + 1)
+                position += len(block)
+
+        offsets = np.concatenate(offsets)
+        if offsets[-1] != position:
+            # Last line without a trailing newline
+            offsets = np.append(offsets, position)
+
+        with atomic_open(offsets_path) as f:
+            np.save(f, offsets)
+
+    @classmethod
+    def load(cls, filename):
+        """
+            Open the index of a file, building it first if needed
+        """
+
+        stat = os.stat(filename)
+        path_hash = hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()[:12]
+        offsets_path = os.path.join(
+            cls.directory,
+            '{}.{}.{}.{}.npy'.format(os.path.basename(filename), path_hash, stat.st_size, int(stat.st_mtime))
+        )
+
+        if not os.path.exists(offsets_path):
+            os.makedirs(cls.directory, exist_ok=True)
+            cls.build(filename, offsets_path)
+
+        if stat.st_size == 0:
+            raise Exception("No lines could be read in file")
+
+        return cls(filename, offsets_path)
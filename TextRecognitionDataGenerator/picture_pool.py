@@ -0,0 +1,136 @@
+import os
+import glob
+import random
+import cv2
+import numpy as np
+
+from PIL import Image, ImageFile
+
+from atomic_file import atomic_open
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+class PicturePool(object):
+    """
+        Decoded grayscale background pictures, scanned once per process.
+
+        Pictures are kept in memory until memory_budget bytes are used, the
+        remaining ones are converted once to raw .npy files in cache_dir and
+        memory-mapped from there. Serving a crop never touches the decoder.
+    """
+
+    directory = './pictures'
+    extensions = ['png', 'jpg', 'jpeg', 'tif']
+    memory_budget = 512 * 1024 * 1024
+    cache_dir = None
+
+    __pictures = None
+    __loaded_from = None
+
+    @classmethod
+    def configure(cls, directory=None, memory_budget=None, cache_dir=None):
+        """
+            Change the pool settings, the pool is reloaded on next use
+        """
+
+        if directory is not None:
+            cls.directory = directory
+        if memory_budget is not None:
+            cls.memory_budget = memory_budget
+        if cache_dir is not None:
+            cls.cache_dir = cache_dir
+        cls.__pictures = None
+
+    @classmethod
+    def __decode(cls, path):
+        return np.array(Image.open(path).convert('L'))
+
+    @classmethod
+    def __memory_map(cls, path, picture=None):
+        """
+            Return a read-only memory map of the raw cache of a picture, creating it if needed
+        """
+
+        cache_dir = cls.cache_dir or os.path.join(cls.directory, '.raw_cache')
+        os.makedirs(cache_dir, exist_ok=True)
+
+        stat = os.stat(path)
+        raw_path = os.path.join(
+            cache_dir,
+            '{}.{}.{}.npy'.format(os.path.basename(path), stat.st_size, int(stat.st_mtime))
+        )
+        if not os.path.exists(raw_path):
+            with atomic_open(raw_path) as f:
+                np.save(f, picture if picture is not None else cls.__decode(path))
+
+        return np.load(raw_path, mmap_mode='r')
+
+    @classmethod
+    def load(cls):
+        """
+            Scan the picture directory and decode (or map) every picture in it
+        """
+
+        paths = []
+        for extension in cls.extensions:
+            paths += glob.glob(os.path.join(cls.directory, '*.' + extension))
+
+        pictures = []
+        used = 0
+        for path in paths:
+            picture = None
+            if used < cls.memory_budget:
+                picture = cls.__decode(path)
+                if used + picture.nbytes <= cls.memory_budget:
+                    used += picture.nbytes
+                    pictures.append(picture)
+                    continue
+            pictures.append(cls.__memory_map(path, picture))
+
+        cls.__pictures = pictures
+        cls.__loaded_from = cls.directory
+
+        return pictures
+
+    @classmethod
+    def pictures(cls):
+        """
+            Return the pooled pictures, loading them on first use
+        """
+
+        if cls.__pictures is None or cls.__loaded_from != cls.directory:
+            cls.load()
+        return cls.__pictures
+
+    @classmethod
+    def crop(cls, height, width):
+        """
+            Return a random height x width grayscale crop of a random picture as an array
+        """
+
+        pictures = cls.pictures()
+        if len(pictures) == 0:
+            raise Exception('No images where found in the pictures folder!')
+
+        picture = pictures[random.randint(0, len(pictures) - 1)]
+
+        # Upscale pictures that are too small, keeping their aspect ratio
+        if picture.shape[1] < width:
+            picture = cv2.resize(
+                picture, (width, int(picture.shape[0] * (width / picture.shape[1]))), interpolation=cv2.INTER_LANCZOS4
+            )
+        if picture.shape[0] < height:
+            picture = cv2.resize(
+                picture, (int(picture.shape[1] * (height / picture.shape[0])), height), interpolation=cv2.INTER_LANCZOS4
+            )
+
+        if picture.shape[1] == width:
+            x = 0
+        else:
+            x = random.randint(0, picture.shape[1] - width)
+        if picture.shape[0] == height:
+            y = 0
+        else:
+            y = random.randint(0, picture.shape[0] - height)
+
+        return picture[y:y + height, x:x + width]
@@ -0,0 +1,117 @@
+import os
+import re
+import json
+import base64
+import tarfile
+import numpy as np
+
+from atomic_file import atomic_open
+
+class ProgressManifest(object):
+    """
+        Completion record of a generation job, kept in its output directory.
+
+        It holds the options the job was planned with (seed included) and one
+        bit per sample index, so an interrupted job can be resumed by
+        replaying the same plan and only scheduling the missing indices.
+    """
+
+    filename = 'progress.json'
+    save_interval = 1000
+
+    def __init__(self, directory, plan, done=None):
+        self.directory = directory
+        self.plan = plan
+        self.done = done if done is not None else np.zeros(plan['count'], dtype=bool)
+        self.unsaved = 0
+
+    def mark(self, index):
+        """
+            Record a finished sample, saving every save_interval samples
+            (never when save_interval is None)
+        """
+
+        self.done[index] = True
+        self.unsaved += 1
+        if self.save_interval is not None and self.unsaved >= self.save_interval:
+            self.save()
+
+    def missing_count(self):
+        return int(len(self.done) - self.done.sum())
+
+    def save(self):
+        """
+            Write the manifest, the completion bits are packed and base64 encoded
+        """
+
+        path = os.path.join(self.directory, self.filename)
+        content = {
+            'plan': self.plan,
+            'done': base64.b64encode(np.packbits(self.done).tobytes()).decode('ascii'),
+        }
+
+        with atomic_open(path, 'w', encoding='utf-8') as f:
+            json.dump(content, f)
+        self.unsaved = 0
+
+    @classmethod
+    def load(cls, directory):
+        """
+            Return the manifest of an output directory, None if there is none
+        """
+
+        path = os.path.join(directory, cls.filename)
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'r', encoding='utf-8') as f:
+            content = json.load(f)
+
+        plan = content['plan']
+        done = np.unpackbits(
+            np.frombuffer(base64.b64decode(content['done']), dtype=np.uint8), count=plan['count']
+        ).astype(bool)
+
+        return cls(directory, plan, done)
+
+    @classmethod
+    def scan(cls, directory, plan):
+        """
+            Rebuild the completion bits from the samples found in an output
+            directory, for jobs that have no manifest
+        """
+
+        done = np.zeros(plan['count'], dtype=bool)
+
+        if plan['output_format'] == 'tar':
+            indices = []
+            for name in os.listdir(directory):
+                if not name.endswith('.tar'):
+                    continue
+                try:
+                    with tarfile.open(os.path.join(directory, name)) as tar:
+                        for member in tar:
+                            if member.name.endswith('.json'):
+                                indices.append(int(member.name.split('.')[0]))
+                except (tarfile.TarError, EOFError):
+                    # Shard cut short by the interruption, keep what was read
+                    pass
+        else:
+            # Image names as written by FakeTextDataGenerator for each name format
+            extension = re.escape(plan['extension'])
+            pattern = {
+                1: r'^(\d+)_.*\.{}$',
+                2: r'^(\d+)\.{}$',
+            }.get(plan['name_format'], r'^.*_(\d+)\.{}$').format(extension)
+            pattern = re.compile(pattern, re.DOTALL)
+
+            indices = []
+            for name in os.listdir(directory):
+                match = pattern.match(name)
+                if match is not None:
+                    indices.append(int(match.group(1)))
+
+        indices = np.array([i for i in indices if i < plan['count']], dtype=np.int64)
+        done[indices] = True
+
+        return cls(directory, plan, done)
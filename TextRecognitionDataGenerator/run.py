@@ -1,23 +1,34 @@
 import argparse
 import os, errno
 import random
-import re
-import requests
-import string
 
-from bs4 import BeautifulSoup
-from PIL import Image, ImageFont, ImageFile
+from PIL import ImageFile
 from data_generator import FakeTextDataGenerator
+from string_generator import create_strings_from_dict, create_strings_randomly
+from font_cache import FontCache
+from picture_pool import PicturePool
+from background_bank import BackgroundBank
+from background_generator import BackgroundGenerator
+from shard_writer import ShardWriter
+from compact_dict import CompactDict
+from line_index import LineIndex
+from progress_manifest import ProgressManifest
+from stage_profiler import StageProfile
+from wikipedia_source import WikipediaSource
+from coverage_index import CoverageIndex
+from multiprocessing import util
+try:
+    from handwritten_text_generator import HandwrittenTextGenerator
+except ImportError:
+    print('Missing modules for handwritten text generation.')
+    HandwrittenTextGenerator = None
 from multiprocessing import Pool
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 import glob
-from itertools import chain
+from itertools import islice
+from contextlib import ExitStack
 import sys
 import math
-from fontTools.ttLib import TTFont
-from fontTools.unicode import Unicode
-from PIL import Image, ImageFont, ImageDraw, ImageFilter
-import numpy as np
 import cv2
 
 def parse_arguments():
@@ -41,6 +52,14 @@ def parse_arguments():
         help="When set, this argument uses a specified text file as source for the text",
         default=""
     )
+    parser.add_argument(
+        "-im",
+        "--input_mode",
+        type=str,
+        nargs="?",
+        help="How lines are drawn from the input file: sequential (in order, looping), uniform (with replacement) or shuffle (without replacement, reshuffled each pass). Only used with -i",
+        default="sequential"
+    )
     parser.add_argument(
         "-l",
         "--language",
@@ -227,18 +246,132 @@ def parse_arguments():
         help="Define the distorsion's orientation. Only used if -d is specified. 0: Vertical (Up and down), 1: Horizontal (Left and Right), 2: Both",
         default=0
     )
+    parser.add_argument(
+        "-fc",
+        "--font_cache_size",
+        type=int,
+        nargs="?",
+        help="Define how many (font, size) pairs each worker keeps loaded in memory",
+        default=4096
+    )
+    parser.add_argument(
+        "-pmb",
+        "--picture_memory_budget",
+        type=int,
+        nargs="?",
+        help="Define how many megabytes of decoded background pictures to keep in memory, the rest is memory-mapped from a raw cache",
+        default=512
+    )
+    parser.add_argument(
+        "-pcd",
+        "--picture_cache_dir",
+        type=str,
+        nargs="?",
+        help="Define where the raw cache of background pictures is written. Defaults to pictures/.raw_cache",
+        default=None
+    )
+    parser.add_argument(
+        "-bgt",
+        "--background_tiles",
+        type=int,
+        nargs="?",
+        help="Define how many large gaussian noise and quasicrystal tiles to render up front, backgrounds are then random crops of them instead of being synthesized for every sample. 0 disables it",
+        default=0
+    )
+    parser.add_argument(
+        "-bgd",
+        "--background_tile_dir",
+        type=str,
+        nargs="?",
+        help="Define where the background tiles are cached on disk, so they are only rendered once per --seed. Defaults to no cache",
+        default=None
+    )
+    parser.add_argument(
+        "-cs",
+        "--chunk_size",
+        type=int,
+        nargs="?",
+        help="Define how many samples are sent to a worker at once",
+        default=16
+    )
+    parser.add_argument(
+        "-of",
+        "--output_format",
+        type=str,
+        nargs="?",
+        help="Define how samples are written. files: one image per sample, tar: size-bounded tar shards holding image, label and metadata of each sample",
+        default="files"
+    )
+    parser.add_argument(
+        "-ss",
+        "--shard_size",
+        type=int,
+        nargs="?",
+        help="Define the size in megabytes after which a tar shard is closed. Only used with -of tar",
+        default=256
+    )
+    parser.add_argument(
+        "-rb",
+        "--render_backend",
+        type=str,
+        nargs="?",
+        help="Define how text is rendered. freetype: lay out every string, atlas: compose strings from cached glyphs (no complex shaping, meant for random character sequences)",
+        default="freetype"
+    )
+    parser.add_argument(
+        "-wkr",
+        "--wikipedia_requests",
+        type=int,
+        nargs="?",
+        help="Define how many Wikipedia pages are fetched concurrently. Only used with -wk",
+        default=8
+    )
+    parser.add_argument(
+        "-sd",
+        "--seed",
+        type=int,
+        nargs="?",
+        help="Seed of the generation. Every sample is seeded from (seed, index), so a seed gives the same images at any thread count. Drawn at random (and printed) when not set",
+        default=None
+    )
 
+    parser.add_argument(
+        "-pl",
+        "--pipeline",
+        type=str,
+        nargs="?",
+        help="Define the augmentation pipeline: pil (PIL images), array (single channel uint8 arrays, written as grayscale images) or fused (array, with rotation, scaling and distorsion done in one warp)",
+        default="pil"
+    )
+    parser.add_argument(
+        "-prof",
+        "--profile",
+        action="store_true",
+        help="Time every stage of every sample and write a per stage and per random branch report to profile.json in the output directory",
+        default=False
+    )
+    parser.add_argument(
+        "-res",
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted generation in --output_dir: its progress manifest (or, without one, the samples already there) tells which indices are missing and only those are generated. The other options must be the same as the original run",
+        default=False
+    )
+    parser.add_argument(
+        "-ckpt",
+        "--checkpoint",
+        action="store_true",
+        help="Keep a progress manifest (progress.json) in --output_dir while generating, so that an interrupted run can be resumed with --resume",
+        default=False
+    )
     return parser.parse_args()
 
 def load_dict(lang):
     """
-        Read the dictionnary file and returns all words in it.
+        Read the dictionnary file and returns all words in it, as a memory-mapped CompactDict.
     """
 
-    lang_dict = []
-    with open(os.path.join('dicts', lang + '.txt'), 'r', encoding="utf8", errors='ignore') as d:
-        lang_dict = d.readlines()
-    return lang_dict
+    return CompactDict.load(os.path.join('dicts', lang + '.txt'))
 
 def load_fonts(lang):
     """
@@ -251,79 +384,19 @@ def load_fonts(lang):
     # else:
     #     return [os.path.join('fonts/latin', font) for font in os.listdir('fonts/latin')]
 
-def create_strings_from_file(filename, count):
-    """
-        Create all strings by reading lines in specified files
-    """
-
-    strings = []
-
-    with open(filename, 'r', encoding="utf8") as f:
-        lines = [l.strip()[0:200] for l in f.readlines()]
-        if len(lines) == 0:
-            raise Exception("No lines could be read in file")
-        while len(strings) < count:
-            if len(lines) > count - len(strings):
-                strings.extend(lines[0:count - len(strings)])
-            else:
-                strings.extend(lines)
-
-    return strings
-
-def create_strings_from_dict(length, allow_variable, count, lang_dict):
-    """
-        Create all strings by picking X random word in the dictionnary
-    """
-
-    dict_len = len(lang_dict)
-    strings = []
-    for _ in range(0, count):
-        current_string = ""
-        for _ in range(0, random.randint(1, length) if allow_variable else length):
-            current_string += lang_dict[random.randrange(dict_len)][:-1]
-            current_string += ' '
-        strings.append(current_string[:-1])
-    return strings
-
 def create_strings_from_wikipedia(minimum_length, count, lang):
     """
         Create all string by randomly picking Wikipedia articles and taking sentences from them.
     """
-    sentences = []
 
-    while len(sentences) < count:
-        # We fetch a random page
-        page = requests.get('https://{}.wikipedia.org/wiki/Special:Random'.format(lang))
+    return WikipediaSource.sentences(minimum_length, count, lang, max_length=80)
 
-        soup = BeautifulSoup(page.text, 'html.parser')
-
-        for script in soup(["script", "style"]):
-            script.extract()
-
-        # Only take a certain length
-        lines = list(filter(
-            lambda s:
-                len(s.split(' ')) > minimum_length
-                and not "Wikipedia" in s
-                and not "wikipedia" in s,
-            [
-                ' '.join(re.findall(r"[\w']+", s.strip()))[0:80] for s in soup.get_text().splitlines()
-            ]
-        ))
-
-        # Remove the last lines that talks about contributing
-        sentences.extend(lines[0:max([1, len(lines) - 5])])
-
-    return sentences[0:count]
-def create_strings_from_fonts(fonts):
+def create_strings_from_fonts(fonts, font_dicts=None):
     strings = []
-    font_dicts = {}
+    font_dicts = {} if font_dicts is None else font_dicts
     for font in fonts:
         if (font not in font_dicts):
-            ttf = TTFont(font, fontNumber=0)
-
-            chars = [u'{0}'.format(chr(x[0])) for x in
-                     list(chain.from_iterable([y + (Unicode[y[0]],) for y in x.cmap.items()] for x in ttf["cmap"].tables))]
+            chars = CoverageIndex.cmap(font)
             font_dicts[font] = chars
         else:
             chars = font_dicts[font]
@@ -331,40 +404,10 @@ def create_strings_from_fonts(fonts):
         strings.append(''.join(random.choice(chars) for i in range(random.randint(0, 100))))
     return strings
 
-def check_character_in_font(char, font):
-    try:
-        for cmap in font['cmap'].tables:
-            if cmap.isUnicode():
-                if ord(char) in cmap.cmap:
-                    return True
-    except Exception as ex:
-        print(ex)
-        print(u'1{}1'.format(char))
-    return False
-
-def check_character_in_fontc1(char, font, height = 32):
-    image_font = ImageFont.truetype(font=font, size=height)
-    text_width, text_height = image_font.getsize(char)
-
-    # text_height = random.randint(text_height, text_height + 30)
-    # text = u'日産コーポレート/個人ゴールドJBC123JAL'
-    txt_img = Image.new('L', (text_width, text_height), 255)
-
-    txt_draw = ImageDraw.Draw(txt_img)
-
-    txt_draw.text((0, 0), u'{0}'.format(char), fill=0, font=image_font)
-
-    txt_img = np.array(txt_img)
-    # cv2.imshow("img", txt_img)
-    # cv2.waitKey(0)
-    # cv2.destroyAllWindows()
-    # txt_img = cv2.cvtColor(txt_img, cv2.COLOR_RGB2GRAY)
-    return len(np.nonzero(np.array(txt_img) != 255)[0]) > 0
-
-def random_latin(fonts):
+def random_latin(fonts, charsets):
     strings = []
-    latin_chars = [x[:-1] for x in open("dicts/latin.txt", encoding="utf-8").readlines()]
-    special_chars = [x[:-1] for x in open("dicts/special_char.txt", encoding="utf-8").readlines()][:-3]
+    latin_chars = charsets['latin']
+    special_chars = charsets['special'][:-3]
     max_length = 60
 
     all_chars = latin_chars + special_chars
@@ -403,17 +446,23 @@ def random_latin(fonts):
         strings.append(generated)
 
     return fonts, strings
-def random_sequences_sjnk(fonts):
+
+def load_sjnk_charsets():
+    """
+        Load the character sets used by random_sequences_sjnk and random_latin
+    """
+
+    return {
+        'latin': [x[:-1] for x in open("dicts/latin.txt", encoding="utf-8").readlines()],
+        'special': [x[:-1] for x in open("dicts/special_char.txt", encoding="utf-8").readlines()],
+        'japan': [x[:-1] for x in open("dicts/japan.txt", encoding="utf-8").readlines()],
+    }
+
+def random_sequences_sjnk(fonts, charsets, font_dicts=None):
     strings = []
 
-    latin_chars = [x[:-1] for x in open("dicts/latin.txt", encoding="utf-8").readlines()]
-    special_chars = [x[:-1] for x in open("dicts/special_char.txt", encoding="utf-8").readlines()]
-    japan_chars = [x[:-1] for x in open("dicts/japan.txt", encoding="utf-8").readlines()]
-    full_chars = latin_chars + special_chars + japan_chars
-    font_dicts = {}
+    font_dicts = {} if font_dicts is None else font_dicts
     max_length = 60
-    print("full chars", len(full_chars))
-    print(math.ceil(len(full_chars)*1.0 / max_length))
     # fonts = ['fonts/sjnk/Arial-Unicode-Regular.ttf'] * int(math.ceil(len(full_chars)*1.0 / max_length)) + fonts
     # for i in range(int(math.ceil(len(full_chars)*1.0 / max_length))):
     #     start_idx = max_length * i
@@ -423,13 +472,11 @@ def random_sequences_sjnk(fonts):
 
     for font in fonts:
         if (font not in font_dicts):
-            ttf = TTFont(font, fontNumber=0)
+            coverage = CoverageIndex.coverage(font, charsets)
 
-            chars = set([u'{0}'.format(chr(x[0])) for x in
-                     list(chain.from_iterable([y + (Unicode[y[0]],) for y in x.cmap.items()] for x in ttf["cmap"].tables))])
-            japan_chars_in_font = [x for x in japan_chars if check_character_in_font(x, ttf) and check_character_in_fontc1(x, font) and x in chars]
-            latin_chars_in_font = [x for x in latin_chars if check_character_in_font(x, ttf) and check_character_in_fontc1(x, font) and x in chars]
-            special_chars_in_font = [x for x in special_chars if check_character_in_font(x, ttf) and check_character_in_fontc1(x, font) and x in chars] + [" " for x in range(1,5)]
+            japan_chars_in_font = coverage['japan']
+            latin_chars_in_font = coverage['latin']
+            special_chars_in_font = coverage['special'] + [" " for x in range(1,5)]
 
             font_dicts[font] = (japan_chars_in_font, latin_chars_in_font, special_chars_in_font)
         else:
@@ -486,47 +533,107 @@ def random_sequences_sjnk(fonts):
         strings.append(generated)
     return fonts, strings
 
-def create_strings_randomly(length, allow_variable, count, let, num, sym, lang):
+def print_text(file, list_):
+    f = open(file, 'w', encoding="utf-8")
+
+    f.writelines(list_)
+
+# Source strings are created this many at a time so memory does not grow with --count
+STRING_BATCH_SIZE = 1000
+
+worker_settings = None
+
+# Options that do not change what gets generated, a job may be resumed with different values
+EXECUTION_OPTIONS = [
+    'output_dir', 'thread_count', 'font_cache_size', 'picture_memory_budget', 'picture_cache_dir', 'background_tile_dir',
+    'chunk_size', 'shard_size', 'wikipedia_requests', 'resume', 'checkpoint', 'profile'
+]
+
+def init_worker(settings, font_cache_size, shard_size):
     """
-        Create all strings by randomly sampling from a pool of characters.
+        Receive the settings shared by every sample, once per worker
     """
 
-    # If none specified, use all three
-    if True not in (let, num, sym):
-        let, num, sym = True, True, True
+    global worker_settings
+    worker_settings = settings
 
-    pool = ''
-    if let:
-        if lang == 'cn':
-            pool += ''.join([chr(i) for i in range(19968, 40908)]) # Unicode range of CHK characters
-        else:
-            pool += string.ascii_letters
-    if num:
-        pool += "0123456789"
-    if sym:
-        pool += "!\"#$%&'()*+,-./:;?@[\\]^_`{|}~"
-
-    if lang == 'cn':
-        min_seq_len = 1
-        max_seq_len = 2
+    FontCache.configure(font_cache_size)
+
+    # Each worker finishes its last tar shard when the pool shuts down
+    ShardWriter.max_bytes = shard_size
+    util.Finalize(None, ShardWriter.close, exitpriority=10)
+
+    # Pay the handwriting model load when the workers start rather than on their first sample
+    if settings['is_handwritten']:
+        HandwrittenTextGenerator.warm_up()
+
+def generate_sample(task):
+    """
+        Generate one sample from its (index, text, font, height) task, returns
+        its index and its stage timings (None unless profiling)
+    """
+
+    index, text, font, height = task
+    return index, FakeTextDataGenerator.generate(index, text, font, height=height, **worker_settings)
+
+def create_strings(args, fonts_arr, lang_dict, charsets, file_lines, font_dicts):
+    """
+        Create the strings of one batch of samples, returns the fonts (which
+        some sources pick themselves) and the strings
+    """
+
+    count = len(fonts_arr)
+
+    if args.use_wikipedia:
+        strings = create_strings_from_wikipedia(args.length, count, args.language)
+    elif args.input_file != '':
+        strings = list(islice(file_lines, count))
+    elif args.random_sequences:
+        strings = create_strings_randomly(args.length, args.random, count,
+                                          args.include_letters, args.include_numbers, args.include_symbols, args.language)
+    elif args.random_sequences_from_font:
+        strings = create_strings_from_fonts(fonts_arr, font_dicts)
+    elif args.random_sequences_sjnk:
+        fonts_arr, strings = random_sequences_sjnk(fonts_arr, charsets, font_dicts)
+    elif args.random_latin_sjnk:
+        fonts_arr, strings = random_latin(fonts_arr, charsets)
     else:
-        min_seq_len = 2
-        max_seq_len = 10
+        strings = create_strings_from_dict(args.length, args.random, count, lang_dict)
 
-    strings = []
-    for _ in range(0, count):
-        current_string = ""
-        for _ in range(0, random.randint(1, length) if allow_variable else length):
-            seq_len = random.randint(min_seq_len, max_seq_len)
-            current_string += ''.join([random.choice(pool) for _ in range(seq_len)])
-            current_string += ' '
-        strings.append(current_string[:-1])
-    return strings
+    return fonts_arr, strings
 
-def print_text(file, list_):
-    f = open(file, 'w', encoding="utf-8")
+def iterate_tasks(args, fonts, lang_dict, charsets, label_files, done=None):
+    """
+        Lazily yield the (index, text, font, height) task of every sample,
+        writing its labels as it goes. Samples flagged in done are planned
+        and labelled all the same, but not yielded.
+    """
 
-    f.writelines(list_)
+    src_file, tgt_file, labels_file = label_files
+
+    # Lines are read through an offset index, the input file is never loaded as a whole
+    file_lines = (
+        l.strip()[0:200] for l in LineIndex.load(args.input_file).iterate(args.input_mode)
+    ) if args.input_file != '' else None
+    font_dicts = {}
+
+    index = 0
+    while index < args.count:
+        batch_size = min(STRING_BATCH_SIZE, args.count - index)
+        fonts_arr = [fonts[random.randrange(0, len(fonts))] for _ in range(0, batch_size)]
+        fonts_arr, strings = create_strings(args, fonts_arr, lang_dict, charsets, file_lines, font_dicts)
+
+        for font, text in zip(fonts_arr, strings):
+            src_file.write('{}_{}.{}\n'.format(args.prefix, str(index), args.extension))
+            tgt_file.write('{}\n'.format(text))
+            if labels_file is not None:
+                # Create file with filename-to-label connections
+                labels_file.write("{} {}\n".format(str(index) + "." + args.extension, text))
+
+            height = random.randint(args.format, args.format + 40)
+            if done is None or not done[index]:
+                yield index, text, font, height
+            index += 1
 
 def main():
     """
@@ -536,6 +643,9 @@ def main():
     # Argument parsing
     args = parse_arguments()
 
+    if args.handwritten and HandwrittenTextGenerator is None:
+        raise Exception("Handwritten text generation is unavailable, its modules (TensorFlow) could not be imported")
+
     # Create the directory if it does not exist.
     try:
         os.makedirs(args.output_dir)
@@ -543,74 +653,120 @@ def main():
         if e.errno != errno.EEXIST:
             raise
 
+    manifest = ProgressManifest.load(args.output_dir) if args.resume else None
+    if args.resume:
+        if args.use_wikipedia:
+            raise Exception("Wikipedia sources cannot be replayed, a job using them cannot be resumed")
+        if manifest is not None and args.seed is None:
+            args.seed = manifest.plan['seed']
+        if manifest is None and args.seed is None:
+            raise Exception("No progress manifest in {}, give the --seed of the interrupted run to resume it".format(args.output_dir))
+
+    if args.seed is None:
+        args.seed = random.SystemRandom().getrandbits(32)
+    print("Seed: {}".format(args.seed))
+    random.seed(args.seed)
+
+    FontCache.configure(args.font_cache_size)
+    WikipediaSource.max_in_flight = args.wikipedia_requests
+
+    # Decode the background pictures once so the workers share them
+    PicturePool.configure(memory_budget=args.picture_memory_budget * 1024 * 1024, cache_dir=args.picture_cache_dir)
+    PicturePool.load()
+
+    # Render the background tiles once so the workers share them
+    BackgroundBank.configure(tile_count=args.background_tiles, seed=args.seed, cache_dir=args.background_tile_dir)
+    BackgroundGenerator.fill_bank()
+
     # Creating word list
     lang_dict = load_dict(args.language)
 
     # Create font (path) list
     fonts = load_fonts(args.language)
-    # print(fonts)
-    # Creating synthetic sentences (or word)
-    strings = []
-
-    fonts_arr = [fonts[random.randrange(0, len(fonts))] for _ in range(0, args.count)]
 
-    if args.use_wikipedia:
-        strings = create_strings_from_wikipedia(args.length, args.count, args.language)
-    elif args.input_file != '':
-        strings = create_strings_from_file(args.input_file, args.count)
-    elif args.random_sequences:
-        strings = create_strings_randomly(args.length, args.random, args.count,
-                                          args.include_letters, args.include_numbers, args.include_symbols, args.language)
-        # Set a name format compatible with special characters automatically if they are used
-        if args.include_symbols or True not in (args.include_letters, args.include_numbers, args.include_symbols):
-            args.name_format = 2
-    elif args.random_sequences_from_font:
-        strings = create_strings_from_fonts(fonts_arr)
-    elif args.random_sequences_sjnk:
-        fonts_arr, strings = random_sequences_sjnk(fonts_arr)
-    elif args.random_latin_sjnk:
-        fonts_arr, strings = random_latin(fonts_arr)
+    # Character sets are read once, not for every batch of strings
+    charsets = load_sjnk_charsets() if args.random_sequences_sjnk or args.random_latin_sjnk else None
+
+    # Index the glyph coverage of every font up front, in parallel, unless it is already on disk
+    if args.random_sequences_sjnk:
+        full_chars = charsets['latin'] + charsets['special'] + charsets['japan']
+        print("full chars", len(full_chars))
+        print(math.ceil(len(full_chars)*1.0 / 60))
+        CoverageIndex.build(fonts, charsets, args.thread_count)
+
+    # Set a name format compatible with special characters automatically if they are used
+    if args.random_sequences and (args.include_symbols or True not in (args.include_letters, args.include_numbers, args.include_symbols)):
+        args.name_format = 2
+
+    # The labels are replayed from the same seed, only the images of the missing indices are generated again
+    plan = {k: v for k, v in sorted(vars(args).items()) if k not in EXECUTION_OPTIONS}
+    if manifest is None:
+        manifest = ProgressManifest.scan(args.output_dir, plan) if args.resume else ProgressManifest(args.output_dir, plan)
+    elif manifest.plan != plan:
+        changed = sorted(k for k in set(plan) | set(manifest.plan) if plan.get(k) != manifest.plan.get(k))
+        raise Exception("Cannot resume, these options differ from the original run: {}".format(', '.join(changed)))
+    elif args.output_format == 'tar':
+        # Samples flushed to the shards after the last save of the manifest must not be generated twice
+        manifest.done |= ProgressManifest.scan(args.output_dir, plan).done
+    if args.resume:
+        print("Resuming, {} of {} samples missing".format(manifest.missing_count(), args.count))
+
+    # Only resumable runs leave a manifest next to the samples
+    if args.checkpoint or args.resume:
+        manifest.save()
     else:
-        strings = create_strings_from_dict(args.length, args.random, args.count, lang_dict)
+        manifest.save_interval = None
+
+    settings = {
+        'out_dir': args.output_dir,
+        'extension': args.extension,
+        'skewing_angle': args.skew_angle,
+        'random_skew': args.random_skew,
+        'blur': args.blur,
+        'random_blur': args.random_blur,
+        'background_type': args.background,
+        'distorsion_type': args.distorsion,
+        'distorsion_orientation': args.distorsion_orientation,
+        'is_handwritten': args.handwritten,
+        'name_format': args.name_format,
+        'text_color': -1,
+        'prefix': args.prefix,
+        'output_format': args.output_format,
+        'render_backend': args.render_backend,
+        'seed': args.seed,
+        'profile': args.profile,
+        'pipeline': args.pipeline,
+    }
+
+    with ExitStack() as stack:
+        src_file = stack.enter_context(open("src-train.txt", 'w', encoding="utf-8"))
+        tgt_file = stack.enter_context(open("tgt-train.txt", 'w', encoding="utf-8"))
+        labels_file = None
+        if args.name_format == 2:
+            labels_file = stack.enter_context(open(os.path.join(args.output_dir, "labels.txt"), 'w', encoding="utf8"))
+
+        tasks = iterate_tasks(args, fonts, lang_dict, charsets, (src_file, tgt_file, labels_file), manifest.done.copy())
+
+        string_count = 0
+        profile = StageProfile()
+        with Pool(args.thread_count, initializer=init_worker, initargs=(settings, args.font_cache_size, args.shard_size * 1024 * 1024)) as p:
+            for index, timings in p.imap_unordered(generate_sample, tasks, chunksize=args.chunk_size):
+                manifest.mark(index)
+                if timings is not None:
+                    profile.add(timings)
+                string_count += 1
+
+            # Let the workers exit normally so their finalizers run
+            p.close()
+            p.join()
+
+        if manifest.save_interval is not None:
+            manifest.save()
 
-
-    string_count = len(strings)
     print("String count", string_count)
-    print_text("src-train.txt", ['{}_{}.{}\n'.format(args.prefix, str(index), args.extension) for index in range(string_count)])
-    print_text("tgt-train.txt", ['{}\n'.format(x) for x in strings])
-
-    p = Pool(args.thread_count)
-    p.starmap(
-        FakeTextDataGenerator.generate,
-        zip(
-            [i for i in range(0, string_count)],
-            strings,
-            fonts_arr,
-            [args.output_dir] * string_count,
-            # [args.format] * string_count,
-            [random.randint(args.format, args.format + 40) for x in range(string_count)],
-            [args.extension] * string_count,
-            [args.skew_angle] * string_count,
-            [args.random_skew] * string_count,
-            [args.blur] * string_count,
-            [args.random_blur] * string_count,
-            [args.background] * string_count,
-            [args.distorsion] * string_count,
-            [args.distorsion_orientation] * string_count,
-            [args.handwritten] * string_count,
-            [args.name_format] * string_count,
-            [-1] * string_count,
-            [args.prefix] * string_count
-        )
-    )
-    p.terminate()
-
-    if args.name_format == 2:
-        # Create file with filename-to-label connections
-        with open(os.path.join(args.output_dir, "labels.txt"), 'w', encoding="utf8") as f:
-            for i in range(string_count):
-                file_name = str(i) + "." + args.extension
-                f.write("{} {}\n".format(file_name, strings[i]))
+
+    if args.profile:
+        profile.report(os.path.join(args.output_dir, 'profile.json'))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,84 @@
+import io
+import os
+import tarfile
+import time
+
+class ShardWriter(object):
+    """
+        Per-process writer of size-bounded tar shards in the WebDataset layout:
+        every sample is a group of consecutive members sharing the same key
+        (e.g. 000000042.jpg, 000000042.txt, 000000042.json).
+
+        Each process writes its own shards, named after its pid, so workers
+        never need to coordinate.
+    """
+
+    max_bytes = 256 * 1024 * 1024
+
+    __pid = None
+    __tar = None
+    __directory = None
+    __size = 0
+    __shard_count = 0
+
+    @classmethod
+    def __check_process(cls):
+        # An archive inherited through fork() belongs to the parent, leave it alone
+        pid = os.getpid()
+        if cls.__pid != pid:
+            cls.__pid = pid
+            cls.__tar = None
+            cls.__directory = None
+            cls.__size = 0
+            cls.__shard_count = 0
+
+    @classmethod
+    def __open(cls, directory):
+        while True:
+            path = os.path.join(directory, 'shard-{}-{:05d}.tar'.format(cls.__pid, cls.__shard_count))
+            cls.__shard_count += 1
+            if not os.path.exists(path):
+                break
+
+        cls.__tar = tarfile.open(path, 'w')
+        cls.__directory = directory
+        cls.__size = 0
+
+    @classmethod
+    def write(cls, directory, key, entries):
+        """
+            Append one sample to the current shard of this process. entries is a
+            list of (extension, bytes) pairs, a new shard is started once the
+            current one holds max_bytes.
+        """
+
+        cls.__check_process()
+
+        if cls.__tar is not None and (cls.__size >= cls.max_bytes or cls.__directory != directory):
+            cls.close()
+        if cls.__tar is None:
+            cls.__open(directory)
+
+        mtime = time.time()
+        for extension, data in entries:
+            info = tarfile.TarInfo('{}.{}'.format(key, extension))
+            info.size = len(data)
+            info.mtime = mtime
+            cls.__tar.addfile(info, io.BytesIO(data))
+            # Header block plus data padded to the 512 bytes tar block size
+            cls.__size += tarfile.BLOCKSIZE + (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+
+        # A written sample must survive the process dying, resumed jobs count on it
+        cls.__tar.fileobj.flush()
+
+    @classmethod
+    def close(cls):
+        """
+            Finish the current shard of this process, if any
+        """
+
+        cls.__check_process()
+
+        if cls.__tar is not None:
+            cls.__tar.close()
+            cls.__tar = None
@@ -0,0 +1,76 @@
+import os
+import numpy as np
+
+from multiprocessing import shared_memory
+
+class SharedRing(object):
+    """
+        Fixed size slots of uint8 pixels in one shared memory block, to hand
+        images from worker processes to their parent without pickling them.
+
+        The parent decides which slot a worker writes to, the worker copies
+        the pixels in and only sends back a (slot, shape) descriptor, which
+        the parent turns into an array viewing the slot. A view stays valid
+        until its slot is handed out again.
+    """
+
+    def __init__(self, slot_count, slot_bytes):
+        self.slot_count = slot_count
+        self.slot_bytes = slot_bytes
+        self.memory = shared_memory.SharedMemory(create=True, size=slot_count * slot_bytes)
+        self.owner = os.getpid()
+
+    def __getstate__(self):
+        # Processes that do not inherit the block (spawn) attach to it by name
+        return {
+            'name': self.memory.name,
+            'slot_count': self.slot_count,
+            'slot_bytes': self.slot_bytes,
+            'owner': self.owner,
+        }
+
+    def __setstate__(self, state):
+        self.slot_count = state['slot_count']
+        self.slot_bytes = state['slot_bytes']
+        self.owner = state['owner']
+        self.memory = shared_memory.SharedMemory(name=state['name'])
+
+    def slot_view(self, slot, shape):
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.memory.buf, offset=slot * self.slot_bytes)
+
+    def write(self, slot, array):
+        """
+            Copy a uint8 array to a slot and return its descriptor. Arrays
+            larger than a slot are returned as is, to travel the usual way.
+        """
+
+        if array.nbytes > self.slot_bytes:
+            return array
+
+        self.slot_view(slot, array.shape)[...] = array
+        return slot, array.shape
+
+    def read(self, descriptor):
+        """
+            Return the array of a descriptor, a view of its slot
+        """
+
+        if isinstance(descriptor, np.ndarray):
+            return descriptor
+
+        slot, shape = descriptor
+        return self.slot_view(slot, shape)
+
+    def close(self):
+        """
+            Release the block, and free it when called by the process that created it
+        """
+
+        try:
+            self.memory.close()
+        except BufferError:
+            # Views handed out are still alive, the mapping goes away with them
+            pass
+
+        if os.getpid() == self.owner:
+            self.memory.unlink()
@@ -0,0 +1,173 @@
+import json
+import math
+import time
+import numpy as np
+
+from collections import OrderedDict
+from itertools import combinations
+
+BACKGROUND_NAMES = ['gaussian_noise', 'plain_white', 'quasicrystal', 'picture']
+DISTORSION_NAMES = ['none', 'sin', 'cos', 'random']
+
+class StageTimer(object):
+    """
+        Wall time of each stage of one sample. When disabled every call is a
+        no-op, so the generator can mark its stages unconditionally.
+    """
+
+    def __init__(self, enabled):
+        self.stages = OrderedDict() if enabled else None
+        self.last = time.perf_counter() if enabled else None
+
+    def mark(self, stage):
+        """
+            Close a stage: the time since the previous mark is added to it
+        """
+
+        if self.stages is None:
+            return
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def record(self, **tags):
+        """
+            Return the picklable (stages, tags) record of the sample, None when disabled
+        """
+
+        if self.stages is None:
+            return None
+        return dict(self.stages), tags
+
+class DurationHistogram(object):
+    """
+        Fixed size summary of a series of durations, so a run of any length
+        is profiled in constant memory. Count, total and maximum are exact,
+        percentiles come from log-spaced bins (about 5% wide) spanning
+        1 microsecond to 1000 seconds.
+    """
+
+    low = 1e-6
+    decades = 9
+    bins_per_decade = 50
+
+    def __init__(self):
+        # One more bin on each side for what falls out of the range
+        self.counts = np.zeros(self.decades * self.bins_per_decade + 2, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = math.inf
+        self.maximum = 0.0
+
+    def add(self, duration):
+        if duration > 0:
+            index = int(math.floor(math.log10(duration / self.low) * self.bins_per_decade)) + 1
+            index = min(max(index, 0), len(self.counts) - 1)
+        else:
+            index = 0
+
+        self.counts[index] += 1
+        self.count += 1
+        self.total += duration
+        self.minimum = min(self.minimum, duration)
+        self.maximum = max(self.maximum, duration)
+
+    def percentile(self, q):
+        """
+            Return the q-th percentile, as the geometric middle of its bin
+        """
+
+        rank = max(int(math.ceil(q / 100 * self.count)), 1)
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        value = self.low * 10 ** ((index - 0.5) / self.bins_per_decade)
+
+        return min(max(value, self.minimum), self.maximum)
+
+class StageProfile(object):
+    """
+        Aggregate of the sample records sent back by the pool workers
+    """
+
+    def __init__(self):
+        self.stage_times = OrderedDict()
+        self.branch_times = OrderedDict()
+        self.sample_count = 0
+
+    @classmethod
+    def __histogram(cls, histograms, key):
+        if key not in histograms:
+            histograms[key] = DurationHistogram()
+        return histograms[key]
+
+    def add(self, record):
+        stages, tags = record
+        self.sample_count += 1
+
+        for stage, duration in stages.items():
+            self.__histogram(self.stage_times, stage).add(duration)
+
+        total = sum(stages.values())
+        tags = ['{}={}'.format(k, v) for k, v in sorted(tags.items())]
+        # Every combination of tags, from each tag on its own to all of them
+        for size in range(1, len(tags) + 1):
+            for branch in combinations(tags, size):
+                self.__histogram(self.branch_times, ', '.join(branch)).add(total)
+
+    @classmethod
+    def summarize(cls, histogram):
+        return OrderedDict([
+            ('count', histogram.count),
+            ('total_s', float(histogram.total)),
+            ('mean_ms', float(histogram.total / histogram.count * 1000)),
+            ('p50_ms', float(histogram.percentile(50) * 1000)),
+            ('p90_ms', float(histogram.percentile(90) * 1000)),
+            ('p99_ms', float(histogram.percentile(99) * 1000)),
+            ('max_ms', float(histogram.maximum * 1000)),
+        ])
+
+    def summary(self):
+        """
+            Per stage and per branch (tag value or combination of them) timings,
+            percentiles are accurate to a few percent
+        """
+
+        stages = OrderedDict((stage, self.summarize(h)) for stage, h in self.stage_times.items())
+        total = sum(s['total_s'] for s in stages.values())
+        for s in stages.values():
+            s['share'] = s['total_s'] / total if total > 0 else 0.0
+
+        return OrderedDict([
+            ('samples', self.sample_count),
+            ('stages', stages),
+            ('branches', OrderedDict(sorted(
+                ((branch, self.summarize(h)) for branch, h in self.branch_times.items()),
+                key=lambda b: -b[1]['mean_ms']
+            ))),
+        ])
+
+    def report(self, path):
+        """
+            Print the summary and save it as JSON to path
+        """
+
+        summary = self.summary()
+
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+
+        if self.sample_count == 0:
+            return
+
+        print('Stage timings over {} samples (saved to {})'.format(self.sample_count, path))
+        print('{:<16} {:>9} {:>9} {:>9} {:>9} {:>7}'.format('stage', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'share'))
+        for stage, s in summary['stages'].items():
+            print('{:<16} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>6.1%}'.format(
+                stage, s['mean_ms'], s['p50_ms'], s['p90_ms'], s['p99_ms'], s['share']
+            ))
+
+        print('Sample time by branch, slowest first')
+        print('{:<60} {:>7} {:>9} {:>9} {:>9}'.format('branch', 'count', 'mean ms', 'p90 ms', 'p99 ms'))
+        for branch, s in summary['branches'].items():
+            print('{:<60} {:>7} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+                branch, s['count'], s['mean_ms'], s['p90_ms'], s['p99_ms']
+            ))
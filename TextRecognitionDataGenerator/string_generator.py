@@ -1,10 +1,11 @@
 import os
 import random
-import re
 import string
-import requests
+import numpy as np
 
-from bs4 import BeautifulSoup
+from functools import lru_cache
+
+from wikipedia_source import WikipediaSource
 
 def create_strings_from_file(filename, count):
     """
@@ -25,61 +26,41 @@ def create_strings_from_file(filename, count):
 
     return strings
 
+def join_words(words, word_counts):
+    """
+        Join consecutive words with spaces, word_counts[i] words per string
+    """
+
+    ends = np.cumsum(word_counts)
+    return [' '.join(words[end - n:end]) for n, end in zip(word_counts, ends)]
+
 def create_strings_from_dict(length, allow_variable, count, lang_dict):
     """
         Create all strings by picking X random word in the dictionnary
     """
 
+    # Seeded from the random module so that random.seed() still drives the sampling
+    rng = np.random.RandomState(random.getrandbits(32))
+
     dict_len = len(lang_dict)
-    strings = []
-    for _ in range(0, count):
-        current_string = ""
-        for _ in range(0, random.randint(1, length) if allow_variable else length):
-            current_string += lang_dict[random.randrange(dict_len)][:-1]
-            current_string += ' '
-        strings.append(current_string[:-1])
-    return strings
+    word_counts = rng.randint(1, length + 1, count) if allow_variable else np.full(count, length)
+    words = [lang_dict[i][:-1] for i in rng.randint(0, dict_len, int(word_counts.sum())).tolist()]
+
+    return join_words(words, word_counts)
 
 def create_strings_from_wikipedia(minimum_length, count, lang):
     """
         Create all string by randomly picking Wikipedia articles and taking sentences from them.
     """
-    sentences = []
 
-    while len(sentences) < count:
-        # We fetch a random page
-        page = requests.get('https://{}.wikipedia.org/wiki/Special:Random'.format(lang))
+    return WikipediaSource.sentences(minimum_length, count, lang, max_length=200)
 
-        soup = BeautifulSoup(page.text, 'html.parser')
-
-        for script in soup(["script", "style"]):
-            script.extract()
-
-        # Only take a certain length
-        lines = list(filter(
-            lambda s:
-                len(s.split(' ')) > minimum_length
-                and not "Wikipedia" in s
-                and not "wikipedia" in s,
-            [
-                ' '.join(re.findall(r"[\w']+", s.strip()))[0:200] for s in soup.get_text().splitlines()
-            ]
-        ))
-
-        # Remove the last lines that talks about contributing
-        sentences.extend(lines[0:max([1, len(lines) - 5])])
-
-    return sentences[0:count]
-
-def create_strings_randomly(length, allow_variable, count, let, num, sym, lang):
+@lru_cache(maxsize=None)
+def character_pool(let, num, sym, lang):
     """
-        Create all strings by randomly sampling from a pool of characters.
+        Return the codepoints random sequences are drawn from, built once per setting
     """
 
-    # If none specified, use all three
-    if True not in (let, num, sym):
-        let, num, sym = True, True, True
-
     pool = ''
     if let:
         if lang == 'cn':
@@ -91,6 +72,19 @@ def create_strings_randomly(length, allow_variable, count, let, num, sym, lang):
     if sym:
         pool += "!\"#$%&'()*+,-./:;?@[\\]^_`{|}~"
 
+    return np.array([ord(c) for c in pool], dtype=np.uint32)
+
+def create_strings_randomly(length, allow_variable, count, let, num, sym, lang):
+    """
+        Create all strings by randomly sampling from a pool of characters.
+    """
+
+    # If none specified, use all three
+    if True not in (let, num, sym):
+        let, num, sym = True, True, True
+
+    pool = character_pool(let, num, sym, lang)
+
     if lang == 'cn':
         min_seq_len = 1
         max_seq_len = 2
@@ -98,12 +92,29 @@ def create_strings_randomly(length, allow_variable, count, let, num, sym, lang):
         min_seq_len = 2
         max_seq_len = 10
 
+    # Seeded from the random module so that random.seed() still drives the sampling
+    rng = np.random.RandomState(random.getrandbits(32))
+
+    # Draw every word count, sequence length and character at once
+    word_counts = rng.randint(1, length + 1, count) if allow_variable else np.full(count, length)
+    seq_lens = rng.randint(min_seq_len, max_seq_len + 1, int(word_counts.sum()))
+    chars = pool[rng.randint(0, len(pool), int(seq_lens.sum()))]
+
+    # Lay every word out followed by a space, then decode everything in one go
+    word_ends = np.cumsum(seq_lens + 1)
+    codepoints = np.full(int(word_ends[-1]) if len(word_ends) else 0, ord(' '), dtype='<u4')
+    is_char = np.ones(len(codepoints), dtype=bool)
+    is_char[word_ends - 1] = False
+    codepoints[is_char] = chars
+    text = codepoints.tobytes().decode('utf-32-le')
+
     strings = []
-    for _ in range(0, count):
-        current_string = ""
-        for _ in range(0, random.randint(1, length) if allow_variable else length):
-            seq_len = random.randint(min_seq_len, max_seq_len)
-            current_string += ''.join([random.choice(pool) for _ in range(seq_len)])
-            current_string += ' '
-        strings.append(current_string[:-1])
-    return strings
\ No newline at end of file
+    last_words = np.cumsum(word_counts)
+    for n, last_word in zip(word_counts.tolist(), last_words.tolist()):
+        if n == 0:
+            strings.append('')
+            continue
+        start = int(word_ends[last_word - n - 1]) if last_word - n > 0 else 0
+        # Drop the space following the last word
+        strings.append(text[start:int(word_ends[last_word - 1]) - 1])
+    return strings
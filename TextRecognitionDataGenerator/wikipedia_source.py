@@ -0,0 +1,191 @@
+import os
+import re
+import json
+import random
+import threading
+import requests
+
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from bs4 import BeautifulSoup
+
+try:
+    import lxml
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+class WikipediaSource(object):
+    """
+        Random Wikipedia sentences, fetched concurrently over a shared
+        keep-alive session.
+
+        The cleaned lines of every fetched page are appended to an on-disk
+        cache (one JSON list per page, one file per language), so reruns and
+        later jobs are served from earlier fetches before going online.
+
+        Within a run (until reset is called) every page is served once: the
+        cached pages are read once and consumed in a random order, new pages
+        are fetched when they run out, and the sentences of a page that were
+        not needed yet are kept for the next call.
+    """
+
+    url = 'https://{}.wikipedia.org/wiki/Special:Random'
+    max_in_flight = 8
+    timeout = 30
+    # Failed fetches (rate limiting, server errors) tolerated per call before giving up
+    max_failures = 16
+    directory = os.path.join('cache', 'wikipedia')
+    use_cache = True
+
+    __session = None
+    __lock = threading.Lock()
+    __unserved_pages = {}
+    __leftovers = {}
+
+    @classmethod
+    def reset(cls):
+        """
+            Start a new run, cached pages may be served again
+        """
+
+        cls.__unserved_pages = {}
+        cls.__leftovers = {}
+
+    @classmethod
+    def session(cls):
+        """
+            Return the session shared by every fetch of this process
+        """
+
+        if cls.__session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=cls.max_in_flight)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            cls.__session = session
+        return cls.__session
+
+    @classmethod
+    def extract_lines(cls, html):
+        """
+            Return the cleaned text lines of a page
+        """
+
+        soup = BeautifulSoup(html, HTML_PARSER)
+
+        for script in soup(["script", "style"]):
+            script.extract()
+
+        return [' '.join(re.findall(r"[\w']+", s.strip())) for s in soup.get_text().splitlines()]
+
+    @classmethod
+    def sentences_from_page(cls, lines, minimum_length, max_length):
+        """
+            Select the usable sentences of a page, as cleaned by extract_lines
+        """
+
+        # Only take a certain length
+        lines = list(filter(
+            lambda s:
+                len(s.split(' ')) > minimum_length
+                and not "Wikipedia" in s
+                and not "wikipedia" in s,
+            [s[0:max_length] for s in lines]
+        ))
+
+        # Remove the last lines that talks about contributing
+        return lines[0:max([1, len(lines) - 5])]
+
+    @classmethod
+    def fetch_page(cls, lang):
+        """
+            Fetch one random page and return its cleaned lines, raise
+            requests.HTTPError when the server answers with an error
+        """
+
+        page = cls.session().get(cls.url.format(lang), timeout=cls.timeout)
+        page.raise_for_status()
+        return cls.extract_lines(page.text)
+
+    @classmethod
+    def __cache_path(cls, lang):
+        return os.path.join(cls.directory, '{}.jsonl'.format(lang))
+
+    @classmethod
+    def cached_pages(cls, lang):
+        """
+            Return the cleaned lines of every page cached for a language
+        """
+
+        path = cls.__cache_path(lang)
+        if not cls.use_cache or not os.path.exists(path):
+            return []
+
+        pages = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    pages.append(json.loads(line))
+                except ValueError:
+                    # Partial line left by an interrupted run
+                    continue
+        return pages
+
+    @classmethod
+    def __cache_page(cls, lang, lines):
+        if not cls.use_cache:
+            return
+
+        with cls.__lock:
+            os.makedirs(cls.directory, exist_ok=True)
+            with open(cls.__cache_path(lang), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(lines, ensure_ascii=False) + '\n')
+
+    @classmethod
+    def sentences(cls, minimum_length, count, lang, max_length=200):
+        """
+            Return count sentences of more than minimum_length words, cut to
+            max_length characters, from cached pages first and then from
+            pages fetched max_in_flight at a time
+        """
+
+        key = (lang, minimum_length, max_length)
+        sentences = cls.__leftovers.pop(key, [])
+
+        if lang not in cls.__unserved_pages:
+            pages = cls.cached_pages(lang)
+            random.shuffle(pages)
+            cls.__unserved_pages[lang] = pages
+
+        pages = cls.__unserved_pages[lang]
+        while len(sentences) < count and len(pages) > 0:
+            sentences.extend(cls.sentences_from_page(pages.pop(), minimum_length, max_length))
+
+        if len(sentences) >= count:
+            cls.__leftovers[key] = sentences[count:]
+            return sentences[0:count]
+
+        failures = 0
+        with ThreadPoolExecutor(max_workers=cls.max_in_flight) as executor:
+            pending = set(executor.submit(cls.fetch_page, lang) for _ in range(cls.max_in_flight))
+            while len(pending) > 0:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        lines = future.result()
+                    except requests.HTTPError:
+                        # An error page is neither used nor cached, another page is fetched instead
+                        failures += 1
+                        if failures > cls.max_failures:
+                            raise
+                        continue
+                    cls.__cache_page(lang, lines)
+                    sentences.extend(cls.sentences_from_page(lines, minimum_length, max_length))
+
+                # Keep the pipe full until we have enough, then let the in flight requests land
+                if len(sentences) < count:
+                    pending |= set(executor.submit(cls.fetch_page, lang) for _ in range(len(done)))
+
+        cls.__leftovers[key] = sentences[count:]
+        return sentences[0:count]
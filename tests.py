@@ -5,6 +5,17 @@ import subprocess
 import hashlib
 import shutil
 import string
+import math
+import random
+import numpy as np
+import tempfile
+import tarfile
+import json
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from itertools import islice
+from collections import namedtuple
+from PIL import Image
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), './TextRecognitionDataGenerator')))
 
@@ -15,6 +26,29 @@ except:
 
 from TextRecognitionDataGenerator.data_generator import FakeTextDataGenerator
 from TextRecognitionDataGenerator.background_generator import BackgroundGenerator
+from TextRecognitionDataGenerator.computer_text_generator import ComputerTextGenerator
+from TextRecognitionDataGenerator.distorsion_generator import DistorsionGenerator
+from font_cache import FontCache
+from picture_pool import PicturePool
+from shard_writer import ShardWriter
+from coverage_index import CoverageIndex
+from binarization import fast_nick_binarize
+from compact_dict import CompactDict
+from line_index import LineIndex
+from progress_manifest import ProgressManifest
+from benchmark import run_suite, compare
+from stage_profiler import StageProfile, DurationHistogram
+from batch_generator import BatchGenerator
+from shared_ring import SharedRing
+try:
+    from handwritten_text_generator import HandwrittenTextGenerator, HandwritingModel
+except ImportError:
+    HandwrittenTextGenerator = HandwritingModel = None
+import array_ops
+from background_bank import BackgroundBank
+from wikipedia_source import WikipediaSource
+from atomic_file import atomic_open
+from TextRecognitionDataGenerator.data_generator import nick_binarize
 from TextRecognitionDataGenerator.string_generator import (
     create_strings_from_file,
     create_strings_from_dict,
@@ -222,6 +256,24 @@ class DataGenerator(unittest.TestCase):
 
         os.remove('tests/out/TEST TEST TEST_5.jpg')
 
+    def test_create_strings_randomly_variable_length(self):
+        strings = create_strings_randomly(4, True, 200, True, False, False, 'en')
+
+        self.assertTrue(
+            len(strings) == 200 and
+            all(1 <= len(s.split(' ')) <= 4 for s in strings) and
+            all(2 <= len(w) <= 10 for s in strings for w in s.split(' ')) and
+            len(set(len(s.split(' ')) for s in strings)) == 4
+        )
+
+    def test_create_strings_follow_seed(self):
+        random.seed(7)
+        first = create_strings_randomly(3, True, 5, False, False, False, 'cn') + create_strings_from_dict(3, True, 5, ['A\n', 'B\n', 'C\n'])
+        random.seed(7)
+        second = create_strings_randomly(3, True, 5, False, False, False, 'cn') + create_strings_from_dict(3, True, 5, ['A\n', 'B\n', 'C\n'])
+
+        self.assertTrue(first == second)
+
     def test_generate_string_with_letters(self):
         s = create_strings_randomly(1, False, 1, True, False, False, 'en')[0]
 
@@ -277,6 +329,952 @@ class DataGenerator(unittest.TestCase):
             len(bkgd.histogram()) > 20 and bkgd.size == (128, 64)
         )
 
+class QuasicrystalTest(unittest.TestCase):
+    def per_pixel_quasicrystal(self, height, width):
+        # Historical implementation, kept as the reference of the vectorized one
+        image = Image.new("L", (width, height))
+        pixels = image.load()
+
+        frequency = random.random() * 30 + 20
+        phase = random.random() * 2 * math.pi
+        rotation_count = random.randint(10, 20)
+
+        for kw in range(width):
+            y = float(kw) / (width - 1) * 4 * math.pi - 2 * math.pi
+            for kh in range(height):
+                x = float(kh) / (height - 1) * 4 * math.pi - 2 * math.pi
+                z = 0.0
+                for i in range(rotation_count):
+                    r = math.hypot(x, y)
+                    a = math.atan2(y, x) + i * math.pi * 2.0 / rotation_count
+                    z += math.cos(r * math.sin(a) * frequency + phase)
+                c = int(255 - round(255 * z / rotation_count))
+                pixels[kw, kh] = c
+        return np.array(image)
+
+    def test_vectorized_pattern_matches_per_pixel_loop(self):
+        for seed, (height, width) in enumerate([(32, 100), (17, 45), (64, 128)]):
+            random.seed(seed)
+            expected = self.per_pixel_quasicrystal(height, width)
+            random.seed(seed)
+            actual = BackgroundGenerator.quasicrystal_pattern(height, width)
+
+            self.assertTrue(np.array_equal(actual, expected))
+
+class DistorsionGeneratorTest(unittest.TestCase):
+    def test_sine_distorsion_shifts_columns(self):
+        image = ComputerTextGenerator.generate('TEST TEST TEST', 'tests/font.ttf', 0, 32)
+        distorted = DistorsionGenerator.sin(image, vertical=True, max_offset=4)
+
+        src = np.array(image)
+        dst = np.array(distorted)
+
+        # Column 90 is shifted by int(sin(90deg) * 4) = 4 pixels down
+        self.assertTrue(
+            distorted.size == (image.size[0], image.size[1] + 8) and
+            distorted.mode == 'L' and
+            (dst[8:8 + src.shape[0], 90] == src[:, 90]).all()
+        )
+
+    def test_random_distorsion_follows_seed(self):
+        image = ComputerTextGenerator.generate('TEST', 'tests/font.ttf', 0, 32)
+
+        random.seed(42)
+        first = np.array(DistorsionGenerator.random(image, vertical=True, horizontal=True))
+        random.seed(42)
+        second = np.array(DistorsionGenerator.random(image, vertical=True, horizontal=True))
+
+        self.assertTrue((first == second).all())
+
+class GlyphAtlasTest(unittest.TestCase):
+    def test_atlas_render_matches_freetype(self):
+        for text in ['TEST TEST TEST', 'AVAWa To Ty', 'Hello, world! 123']:
+            for height in [32, 57]:
+                freetype = np.array(ComputerTextGenerator.generate(text, 'tests/font.ttf', 10, height))
+                atlas = np.array(ComputerTextGenerator.generate(text, 'tests/font.ttf', 10, height, 'atlas'))
+
+                self.assertTrue(
+                    freetype.shape == atlas.shape and
+                    np.abs(freetype.astype(int) - atlas).mean() < 1
+                )
+
+    def test_atlas_render_with_custom_font(self):
+        font = 'TextRecognitionDataGenerator/fonts/latin/Pacifico.ttf'
+        freetype = np.array(ComputerTextGenerator.generate('fjord gyp', font, 10, 40))
+        atlas = np.array(ComputerTextGenerator.generate('fjord gyp', font, 10, 40, 'atlas'))
+
+        self.assertTrue(
+            freetype.shape == atlas.shape and
+            np.abs(freetype.astype(int) - atlas).mean() < 1
+        )
+
+class StubHandwritingSession(object):
+    """
+        Stands in for the handwriting session: every sequence of the batch
+        finishes after 3 steps per character, counting the closing space
+    """
+
+    def __init__(self):
+        self.runs = 0
+        self.step = 0
+
+    def run(self, fetches, feed_dict=None):
+        self.runs += 1
+        if fetches == 'zero_states':
+            self.step = 0
+            return None
+
+        self.step += 1
+        sequence = feed_dict['sequence']
+        batch = sequence.shape[0]
+        values = {
+            'e': np.full((batch, 1), 0.2),
+            'pi': np.full((batch, 20), 1 / 20.),
+            'mu1': np.random.standard_normal((batch, 20)),
+            'mu2': np.random.standard_normal((batch, 20)),
+            'std1': np.ones((batch, 20)),
+            'std2': np.ones((batch, 20)),
+            'rho': np.zeros((batch, 20)),
+            'finish': (self.step >= 3 * sequence.max(axis=2).sum(axis=1))[:, None].astype(np.float32),
+        }
+        return [values[name] for name in fetches]
+
+@unittest.skipIf(HandwrittenTextGenerator is None, 'TensorFlow is not installed')
+class HandwrittenTextGeneratorTest(unittest.TestCase):
+    def setUp(self):
+        self.get = HandwritingModel.__dict__['get']
+        self.session = StubHandwritingSession()
+        params = namedtuple('Params', HandwritingModel.fields)(*HandwritingModel.fields)
+        translation = {c: i for i, c in enumerate(' ' + string.ascii_lowercase)}
+        HandwritingModel.get = classmethod(lambda cls: (self.session, params, translation))
+
+    def tearDown(self):
+        HandwritingModel.get = self.get
+
+    def test_words_of_any_length_are_sampled_together(self):
+        words = ['a', 'bb', 'ccc', 'dddd', 'eeeee']
+
+        session, params, translation = HandwritingModel.get()
+        samples = HandwrittenTextGenerator._HandwrittenTextGenerator__sample_texts(session, params, words, translation)
+        sample_runs = self.session.runs
+
+        self.session.runs = 0
+        image = HandwrittenTextGenerator.generate(' '.join(words))
+
+        # One run to reset the state, then as many as the longest word needs
+        self.assertTrue(
+            [len(coords) for _, coords in samples] == [1 + 3 * (len(w) + 1) for w in words] and
+            sample_runs == 1 + 3 * 6 and
+            self.session.runs == sample_runs and
+            image.mode == 'L' and image.size[1] > 0
+        )
+
+    def test_strokes_are_stretched_to_the_word_box(self):
+        rasterize = HandwrittenTextGenerator._HandwrittenTextGenerator__rasterize_strokes
+        strokes = [np.array([[0., 0.], [10., 5.], [20., 0.]]), np.array([[5., -5.], [15., 10.]])]
+
+        thin = rasterize(strokes)
+        thick = rasterize(strokes, stroke_width=6)
+
+        rows, columns = np.nonzero(thin < 255)
+        self.assertTrue(
+            thin.dtype == np.uint8 and
+            thin.shape == (HandwrittenTextGenerator.word_height, HandwrittenTextGenerator.word_width) and
+            thin.min() == HandwrittenTextGenerator.stroke_color and
+            columns.min() <= 1 and columns.max() >= thin.shape[1] - 2 and
+            rows.min() <= 1 and rows.max() >= thin.shape[0] - 2 and
+            (thick < 255).sum() > 1.5 * (thin < 255).sum()
+        )
+
+    def test_array_is_sized_to_the_strokes(self):
+        rasterize = HandwrittenTextGenerator._HandwrittenTextGenerator__rasterize_strokes
+
+        dash = rasterize([np.array([[0., 3.], [10., 3.]])])
+        thick_dash = rasterize([np.array([[0., 3.], [10., 3.]])], stroke_width=6)
+
+        self.assertTrue(
+            dash.shape == (5, HandwrittenTextGenerator.word_width) and
+            thick_dash.shape == (9, HandwrittenTextGenerator.word_width) and
+            (dash < 255).any(axis=0)[1:-1].all()
+        )
+
+@unittest.skipIf(HandwritingModel is None, 'TensorFlow is not installed')
+class HandwritingModelTest(unittest.TestCase):
+    def setUp(self):
+        self.model_dir = HandwritingModel.model_dir
+        HandwritingModel.model_dir = 'tests/missing_model'
+
+    def tearDown(self):
+        HandwritingModel.model_dir = self.model_dir
+        HandwritingModel._HandwritingModel__pid = None
+
+    def test_model_is_loaded_once_per_process(self):
+        session, params, translation = object(), object(), {'a': 1}
+        HandwritingModel._HandwritingModel__session = session
+        HandwritingModel._HandwritingModel__params = params
+        HandwritingModel._HandwritingModel__translation = translation
+
+        # Loaded by this process: nothing is read again
+        HandwritingModel._HandwritingModel__pid = os.getpid()
+        cached = HandwritingModel.get()
+
+        # Inherited from a parent process: the model is read again
+        HandwritingModel._HandwritingModel__pid = os.getpid() + 1
+        with self.assertRaises(FileNotFoundError):
+            HandwritingModel.get()
+
+        self.assertTrue(cached == (session, params, translation))
+
+class BinarizationTest(unittest.TestCase):
+    def test_fast_nick_binarize_matches_nick_binarize(self):
+        img_list = []
+        for text, height in [('TEST TEST TEST', 70), ('TEST', 90)]:
+            text_img = ComputerTextGenerator.generate(text, 'tests/font.ttf', 30, height)
+            background = BackgroundGenerator.gaussian_noise(text_img.size[1] + 10, text_img.size[0] + 10)
+            background.paste(text_img, (5, 5))
+            img_list.append(np.array(background))
+
+        expected = nick_binarize(img_list)
+        results = fast_nick_binarize(img_list)
+
+        self.assertTrue(
+            len(results) == 2 and
+            all(e.shape == r.shape and (e != r).mean() < 0.01 for e, r in zip(expected, results))
+        )
+
+class FontCacheTest(unittest.TestCase):
+    def setUp(self):
+        FontCache.clear()
+        FontCache.configure(2)
+
+    def tearDown(self):
+        FontCache.configure(4096)
+        FontCache.clear()
+
+    def test_font_cache_hits_and_misses(self):
+        first = FontCache.get('tests/font.ttf', 32)
+        second = FontCache.get('tests/font.ttf', 32)
+        FontCache.get('tests/font.ttf', 33)
+
+        stats = FontCache.stats()
+
+        self.assertTrue(
+            first is second and
+            stats['hits'] == 1 and
+            stats['misses'] == 2 and
+            stats['size'] == 2
+        )
+
+    def test_font_cache_evicts_least_recently_used(self):
+        first = FontCache.get('tests/font.ttf', 32)
+        FontCache.get('tests/font.ttf', 33)
+        FontCache.get('tests/font.ttf', 32)
+        FontCache.get('tests/font.ttf', 34)
+
+        self.assertTrue(
+            FontCache.get('tests/font.ttf', 32) is first and
+            FontCache.stats()['size'] == 2 and
+            FontCache.stats()['misses'] == 3
+        )
+
+        FontCache.get('tests/font.ttf', 33)
+
+        self.assertTrue(FontCache.stats()['misses'] == 4)
+
+class PicturePoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        BackgroundGenerator.gaussian_noise(120, 200).save(os.path.join(self.directory, 'noise.png'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        PicturePool.configure(directory='./pictures', memory_budget=512 * 1024 * 1024)
+
+    def test_picture_pool_crop_in_memory(self):
+        PicturePool.configure(directory=self.directory, memory_budget=1024 * 1024)
+
+        crop = PicturePool.crop(40, 300)
+
+        self.assertTrue(
+            crop.shape == (40, 300) and
+            crop.dtype == 'uint8' and
+            not os.path.exists(os.path.join(self.directory, '.raw_cache'))
+        )
+
+    def test_picture_pool_crop_memory_mapped(self):
+        PicturePool.configure(directory=self.directory, memory_budget=0)
+
+        crop = PicturePool.crop(30, 50)
+
+        self.assertTrue(
+            crop.shape == (30, 50) and
+            len(os.listdir(os.path.join(self.directory, '.raw_cache'))) == 1
+        )
+
+    def test_picture_background_is_grayscale(self):
+        PicturePool.configure(directory=self.directory)
+
+        bkgd = BackgroundGenerator.picture(64, 128)
+
+        self.assertTrue(bkgd.mode == 'L' and bkgd.size == (128, 64))
+
+class ShardWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        PicturePool.configure(directory='tests/expected_results')
+
+    def tearDown(self):
+        ShardWriter.close()
+        ShardWriter.max_bytes = 256 * 1024 * 1024
+        shutil.rmtree(self.directory)
+        PicturePool.configure(directory='./pictures')
+
+    def test_generate_data_in_tar_shard(self):
+        for i in range(3):
+            FakeTextDataGenerator.generate(
+                i, 'TEST TEST TEST', 'tests/font.ttf', self.directory, 32, 'jpg',
+                0, False, 0, False, 1, 0, 0, False, 0, 1, output_format='tar'
+            )
+        ShardWriter.close()
+
+        shards = os.listdir(self.directory)
+        with tarfile.open(os.path.join(self.directory, shards[0])) as tar:
+            names = tar.getnames()
+            label = tar.extractfile('000000001.txt').read().decode('utf-8')
+            meta = json.loads(tar.extractfile('000000001.json').read().decode('utf-8'))
+
+        self.assertTrue(
+            len(shards) == 1 and
+            names[:3] == ['000000000.jpg', '000000000.txt', '000000000.json'] and
+            len(names) == 9 and
+            label == 'TEST TEST TEST' and
+            meta['index'] == 1
+        )
+
+    def test_shards_are_size_bounded(self):
+        ShardWriter.max_bytes = 1
+        for i in range(3):
+            ShardWriter.write(self.directory, '{:09d}'.format(i), [('txt', b'TEST')])
+        ShardWriter.close()
+
+        self.assertTrue(len(os.listdir(self.directory)) == 3)
+
+class SampleSeedTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        PicturePool.configure(directory='tests/expected_results')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        PicturePool.configure(directory='./pictures')
+
+    def generate(self, index, out_dir):
+        FakeTextDataGenerator.generate(
+            index, 'TEST TEST TEST', 'tests/font.ttf', out_dir, 32, 'png',
+            10, True, 2, True, 0, 3, 2, False, 0, 1, seed=5
+        )
+        with open(os.path.join(out_dir, 'TEST TEST TEST_{}.png'.format(index)), 'rb') as f:
+            return f.read()
+
+    def test_sample_only_depends_on_seed_and_index(self):
+        alone = self.generate(3, self.directory)
+
+        second_dir = os.path.join(self.directory, 'second')
+        os.makedirs(second_dir)
+        random.seed(11)
+        for i in range(3):
+            self.generate(i, second_dir)
+
+        self.assertTrue(self.generate(3, second_dir) == alone and self.generate(2, second_dir) != alone)
+
+class ProgressManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.plan = {'count': 12, 'seed': 3, 'extension': 'jpg', 'name_format': 0, 'output_format': 'files'}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_manifest_round_trip(self):
+        manifest = ProgressManifest(self.directory, self.plan)
+        manifest.mark(0)
+        manifest.mark(11)
+        manifest.save()
+
+        loaded = ProgressManifest.load(self.directory)
+
+        self.assertTrue(
+            loaded.plan == self.plan and
+            list(np.flatnonzero(loaded.done)) == [0, 11] and
+            loaded.missing_count() == 10
+        )
+
+    def test_scan_output_directory(self):
+        for name in ['TEST_1.jpg', 'a_b_4.jpg', 'TEST_5.png', 'TEST_40.jpg']:
+            open(os.path.join(self.directory, name), 'w').close()
+        files = ProgressManifest.scan(self.directory, self.plan)
+
+        ShardWriter.write(self.directory, '{:09d}'.format(7), [('jpg', b'0'), ('txt', b'TEST'), ('json', b'{}')])
+        ShardWriter.close()
+        self.plan['output_format'] = 'tar'
+        shards = ProgressManifest.scan(self.directory, self.plan)
+
+        self.assertTrue(list(np.flatnonzero(files.done)) == [1, 4] and list(np.flatnonzero(shards.done)) == [7])
+
+class BenchmarkTest(unittest.TestCase):
+    def test_run_suite(self):
+        results = run_suite(['tests/font.ttf', 'TextRecognitionDataGenerator/fonts/latin/Aller_Rg.ttf'], [32, 64], [5], 2, ['rotate', 'paste'])
+
+        self.assertTrue(
+            list(results) == [
+                'rotate/font.ttf/h32/l5', 'rotate/font.ttf/h64/l5',
+                'rotate/Aller_Rg.ttf/h32/l5', 'rotate/Aller_Rg.ttf/h64/l5',
+                'paste/font.ttf/h32/l5', 'paste/font.ttf/h64/l5',
+                'paste/Aller_Rg.ttf/h32/l5', 'paste/Aller_Rg.ttf/h64/l5',
+            ] and
+            all(r['calls'] == 2 and r['p50_ms'] <= r['p99_ms'] for r in results.values())
+        )
+
+    def test_compare_flags_regressions(self):
+        baseline = {'rotate/font.ttf/h32/l5': {'p50_ms': 1.0}, 'paste/font.ttf/h32/l5': {'p50_ms': 1.0}}
+        results = {
+            'rotate/font.ttf/h32/l5': {'p50_ms': 1.1},
+            'paste/font.ttf/h32/l5': {'p50_ms': 1.3},
+            'save/font.ttf/h32/l5': {'p50_ms': 9.0},
+        }
+
+        self.assertTrue(compare(results, baseline, 0.15) == [('paste/font.ttf/h32/l5', 1.0, 1.3)])
+
+class StageProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        PicturePool.configure(directory='tests/expected_results')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        PicturePool.configure(directory='./pictures')
+
+    def test_generate_returns_stage_timings(self):
+        arguments = [0, 'TEST TEST TEST', 'tests/font.ttf', self.directory, 32, 'jpg', 0, False, 0, False, 1, 0, 0, False, 0, 1]
+
+        stages, tags = FakeTextDataGenerator.generate(*arguments, profile=True)
+
+        self.assertTrue(
+            FakeTextDataGenerator.generate(*arguments) is None and
+            list(stages)[0:2] == ['render', 'rotate'] and list(stages)[-1] == 'save' and
+            set(tags) == {'background', 'distorsion', 'binarized'}
+        )
+
+    def test_profile_aggregates_records(self):
+        profile = StageProfile()
+        profile.add(({'render': 0.001, 'save': 0.003}, {'background': 'picture', 'binarized': False}))
+        profile.add(({'render': 0.003, 'save': 0.001}, {'background': 'plain_white', 'binarized': False}))
+        profile.report(os.path.join(self.directory, 'profile.json'))
+
+        with open(os.path.join(self.directory, 'profile.json'), 'r') as f:
+            summary = json.load(f)
+
+        self.assertTrue(
+            summary['samples'] == 2 and
+            summary['stages']['render']['count'] == 2 and
+            abs(summary['stages']['save']['share'] - 0.5) < 1e-9 and
+            summary['branches']['binarized=False']['count'] == 2 and
+            summary['branches']['background=picture, binarized=False']['count'] == 1
+        )
+
+    def test_every_combination_of_tags_is_a_branch(self):
+        profile = StageProfile()
+        profile.add(({'render': 0.001}, {'background': 'picture', 'distorsion': 'sin', 'binarized': True}))
+
+        self.assertTrue(
+            len(profile.branch_times) == 7 and
+            'background=picture, distorsion=sin' in profile.branch_times and
+            'background=picture, binarized=True, distorsion=sin' in profile.branch_times
+        )
+
+    def test_percentiles_in_constant_memory(self):
+        durations = np.random.RandomState(0).lognormal(-6, 1, 20000)
+        profile = StageProfile()
+        for duration in durations:
+            profile.add(({'render': duration}, {'background': 'picture'}))
+
+        histogram = profile.stage_times['render']
+        summary = profile.summary()['stages']['render']
+
+        self.assertTrue(
+            histogram.counts.size == DurationHistogram().counts.size and
+            summary['count'] == 20000 and
+            abs(summary['total_s'] - durations.sum()) < 1e-9 and
+            summary['max_ms'] == durations.max() * 1000 and
+            all(
+                abs(summary['p{}_ms'.format(q)] / (np.percentile(durations, q) * 1000) - 1) < 0.05
+                for q in [50, 90, 99]
+            )
+        )
+
+class BatchGeneratorTest(unittest.TestCase):
+    def setUp(self):
+        PicturePool.configure(directory='tests/expected_results')
+
+    def tearDown(self):
+        PicturePool.configure(directory='./pictures')
+
+    def test_batches_are_in_memory_and_reproducible(self):
+        texts = ['TEST {}'.format(i) for i in range(10)]
+
+        batches = list(BatchGenerator(texts, ['tests/font.ttf'], batch_size=4, processes=2, prefetch=2, seed=3, height=(32, 40)))
+        other = list(BatchGenerator(texts, ['tests/font.ttf'], batch_size=3, processes=1, seed=3, height=(32, 40)))
+
+        samples = [sample for batch in batches for sample in batch]
+        other_samples = [sample for batch in other for sample in batch]
+
+        self.assertTrue(
+            [len(batch) for batch in batches] == [4, 4, 2] and
+            [label for _, label in samples] == texts and
+            all(image.dtype == np.uint8 and image.ndim == 2 for image, _ in samples) and
+            all(np.array_equal(a, b) for (a, _), (b, _) in zip(samples, other_samples))
+        )
+
+    def test_shared_memory_transport(self):
+        texts = ['TEST {}'.format(i) for i in range(7)]
+
+        piped = list(BatchGenerator(texts, ['tests/font.ttf'], batch_size=2, processes=2, prefetch=1, seed=3))
+        shared = [
+            [(np.array(image), label) for image, label in batch]
+            for batch in BatchGenerator(texts, ['tests/font.ttf'], batch_size=2, processes=2, prefetch=1, seed=3, transport='shared_memory')
+        ]
+
+        self.assertTrue(
+            [label for batch in shared for _, label in batch] == texts and
+            all(np.array_equal(a, b) for x, y in zip(piped, shared) for (a, _), (b, _) in zip(x, y))
+        )
+
+class SharedRingTest(unittest.TestCase):
+    def test_write_and_read_slots(self):
+        ring = SharedRing(2, 64)
+        small = np.arange(24, dtype=np.uint8).reshape(4, 6)
+        large = np.zeros((10, 10), dtype=np.uint8)
+
+        descriptor = ring.write(1, small)
+        fallback = ring.write(0, large)
+        read = np.array(ring.read(descriptor))
+        ring.close()
+
+        self.assertTrue(descriptor == (1, (4, 6)) and np.array_equal(read, small) and fallback is large)
+
+class ArrayPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        PicturePool.configure(directory='tests/expected_results')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        PicturePool.configure(directory='./pictures')
+
+    def test_rotate_expand_matches_pil(self):
+        img = np.random.RandomState(0).randint(0, 256, (40, 200)).astype(np.uint8)
+
+        rotated = array_ops.rotate_expand(img, 3.7)
+        expected = np.array(Image.fromarray(img).rotate(3.7, expand=1))
+
+        self.assertTrue(rotated.shape == expected.shape and (rotated != expected).mean() < 0.01)
+
+    def test_paste_masked_clips_and_skips_black_and_white(self):
+        background = np.full((4, 6), 100, dtype=np.uint8)
+        img = np.array([[0, 50, 255, 60]] * 3, dtype=np.uint8)
+
+        array_ops.paste_masked(background, img, 3, 2)
+
+        self.assertTrue(
+            background[2].tolist() == [100, 100, 100, 100, 50, 100] and
+            background[3].tolist() == [100, 100, 100, 100, 50, 100] and
+            background[1].tolist() == [100] * 6
+        )
+
+    def test_array_pipeline_takes_the_same_branches(self):
+        for index in range(6):
+            arguments = [index, 'TEST TEST TEST', 'tests/font.ttf', 64, 10, True, 2, True, 0, 0, 0, False]
+            image, tags = FakeTextDataGenerator.generate_image(*arguments, seed=8)
+            array, array_tags = FakeTextDataGenerator.generate_array(*arguments, seed=8)
+
+            self.assertTrue(
+                array.dtype == np.uint8 and array.ndim == 2 and
+                array_tags == tags and
+                abs(array.shape[0] - image.size[1]) <= 2 and abs(array.shape[1] - image.size[0]) <= 2
+            )
+
+    def test_generate_with_array_pipeline(self):
+        FakeTextDataGenerator.generate(
+            0, 'TEST TEST TEST', 'tests/font.ttf', self.directory, 32, 'png',
+            0, False, 0, False, 1, 0, 0, False, 2, 1, pipeline='array'
+        )
+
+        self.assertTrue(np.array(Image.open(os.path.join(self.directory, '0.png'))).ndim == 2)
+
+    def test_fused_warp_matches_separate_steps(self):
+        img = np.zeros((40, 200), dtype=np.uint8)
+        img[10:30, 20:180] = 200
+        distorsion = (True, False, 2, DistorsionGenerator.offset_function(1, 2))
+
+        fused = array_ops.fused_warp(img, 3.7, 0.95, distorsion)
+        separate = DistorsionGenerator.apply_func_distorsion(
+            array_ops.resize(array_ops.rotate_expand(img, 3.7), 0.95, 'bilinear'), *distorsion
+        )
+
+        self.assertTrue(
+            fused.shape == separate.shape and
+            np.abs(fused.astype(int) - separate).mean() < 10
+        )
+
+    def test_fused_pipeline_takes_the_same_branches(self):
+        for index in range(6):
+            arguments = [index, 'TEST TEST TEST', 'tests/font.ttf', 64, 10, True, 2, True, 0, 0, 0, False]
+            _, tags = FakeTextDataGenerator.generate_image(*arguments, seed=8)
+            array, array_tags = FakeTextDataGenerator.generate_array(*arguments, seed=8, fused_warp=True)
+
+            self.assertTrue(array.dtype == np.uint8 and array.ndim == 2 and array_tags == tags)
+
+class BackgroundBankTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        BackgroundBank.configure(tile_count=2, tile_height=32, tile_width=128)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        BackgroundBank.configure(tile_count=0, tile_height=256, tile_width=2048, seed=0, cache_dir=None)
+
+    def test_backgrounds_are_crops_of_the_tiles(self):
+        tiles = BackgroundBank.tiles('gaussian_noise', BackgroundGenerator.gaussian_noise_tile)
+        snapshot = [np.array(tile) for tile in tiles]
+
+        background = BackgroundGenerator.gaussian_noise_array(20, 100)
+        background[...] = 0
+
+        self.assertTrue(
+            len(tiles) == 2 and tiles[0].shape == (32, 128) and
+            BackgroundGenerator.quasicrystal_array(20, 100).shape == (20, 100) and
+            BackgroundGenerator.gaussian_noise(20, 100).size == (100, 20) and
+            all((tile == before).all() for tile, before in zip(tiles, snapshot))
+        )
+
+    def test_larger_backgrounds_are_synthesized(self):
+        self.assertTrue(
+            BackgroundBank.crop('quasicrystal', 40, 100, BackgroundGenerator.quasicrystal_pattern) is None and
+            BackgroundGenerator.quasicrystal_array(40, 100).shape == (40, 100)
+        )
+
+    def test_quasicrystal_crops_look_like_synthesized_backgrounds(self):
+        BackgroundBank.configure(tile_count=8, tile_height=256, tile_width=2048)
+        height, width = BackgroundGenerator.quasicrystal_tile_sample
+
+        def statistics(images):
+            images = [image.astype(np.float64) for image in images]
+            return np.array([
+                np.mean([np.abs(np.diff(image, axis=1)).mean() for image in images]),
+                np.mean([np.abs(np.diff(image, axis=0)).mean() for image in images]),
+                np.mean([image.std() for image in images])
+            ])
+
+        random.seed(0)
+        crops = statistics([BackgroundGenerator.quasicrystal_array(height, width) for _ in range(40)])
+        BackgroundBank.configure(tile_count=0)
+        synthesized = statistics([BackgroundGenerator.quasicrystal_array(height, width) for _ in range(40)])
+
+        # Mean horizontal and vertical gradients and contrast within a quarter of each other
+        self.assertTrue((np.abs(crops / synthesized - 1) < 0.25).all())
+
+    def test_tiles_are_cached_and_reproducible(self):
+        rendered = np.array(BackgroundBank.tiles('quasicrystal', BackgroundGenerator.quasicrystal_pattern)[1])
+
+        BackgroundBank.configure(cache_dir=self.directory)
+        cached = BackgroundBank.tiles('quasicrystal', BackgroundGenerator.quasicrystal_pattern)[1]
+        BackgroundBank.configure()
+        loaded = BackgroundBank.tiles('quasicrystal', BackgroundGenerator.quasicrystal_pattern)[1]
+
+        self.assertTrue(
+            len(os.listdir(self.directory)) == 2 and
+            isinstance(loaded, np.memmap) and
+            (cached == rendered).all() and (loaded == rendered).all()
+        )
+
+    def test_tiles_follow_the_seed(self):
+        BackgroundBank.configure(seed=1, cache_dir=self.directory)
+        first = np.array(BackgroundBank.tiles('gaussian_noise', BackgroundGenerator.gaussian_noise_tile)[0])
+        BackgroundBank.configure(seed=2, cache_dir=None)
+        second = BackgroundBank.tiles('gaussian_noise', BackgroundGenerator.gaussian_noise_tile)[0]
+
+        self.assertTrue(
+            BackgroundBank.cache_dir is None and
+            not isinstance(second, np.memmap) and
+            not (first == second).all() and
+            len(os.listdir(self.directory)) == 2
+        )
+
+class CoverageIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        CoverageIndex.directory = self.directory
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        CoverageIndex.directory = os.path.join('cache', 'coverage')
+
+    def test_coverage_is_computed_and_persisted(self):
+        charsets = {'latin': ['A', 'b', '7'], 'cjk': [chr(19968), chr(19969)]}
+
+        CoverageIndex.build(['tests/font.ttf'], charsets)
+        coverage = CoverageIndex.coverage('tests/font.ttf', charsets)
+
+        self.assertTrue(
+            coverage == CoverageIndex.compute('tests/font.ttf', charsets) and
+            coverage['latin'] == ['A', 'b', '7'] and
+            coverage['cjk'] == [] and
+            len([name for name in os.listdir(self.directory) if name.startswith('coverage-')]) == 1
+        )
+
+    def test_cmap_is_persisted(self):
+        chars = CoverageIndex.cmap('tests/font.ttf')
+
+        self.assertTrue(
+            'A' in chars and
+            len([name for name in os.listdir(self.directory) if name.startswith('cmap-')]) == 1
+        )
+
+    def test_font_is_hashed_only_when_it_changes(self):
+        font = os.path.join(self.directory, 'font.ttf')
+        shutil.copy('tests/font.ttf', font)
+        os.utime(font, (1000000000, 1000000000))
+
+        first = CoverageIndex.font_hash(font)
+
+        # Same path, size and mtime in a new process: the indexed hash is trusted
+        CoverageIndex._CoverageIndex__entries = {}
+        with open(font, 'r+b') as f:
+            f.write(b'\xff')
+        os.utime(font, (1000000000, 1000000000))
+        unchanged = CoverageIndex.font_hash(font)
+
+        os.utime(font, (1000000001, 1000000001))
+        changed = CoverageIndex.font_hash(font)
+
+        with open(font, 'rb') as f:
+            self.assertTrue(
+                unchanged == first and
+                changed != first and
+                changed == hashlib.sha1(f.read()).hexdigest()
+            )
+
+class CompactDictTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        CompactDict.directory = os.path.join(self.directory, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        CompactDict.directory = os.path.join('cache', 'dicts')
+
+    def test_compact_dict_matches_readlines(self):
+        filename = os.path.join(self.directory, 'words.txt')
+        with open(filename, 'w', encoding='utf8') as f:
+            f.write('TEST\nété\n日産\nlast')
+
+        lang_dict = CompactDict.load(filename)
+
+        self.assertTrue(
+            list(lang_dict) == ['TEST\n', 'été\n', '日産\n', 'last'] and
+            lang_dict[-1] == 'last' and
+            len(os.listdir(CompactDict.directory)) == 2
+        )
+
+    def test_create_strings_from_compact_dict(self):
+        filename = os.path.join(self.directory, 'words.txt')
+        with open(filename, 'w', encoding='utf8') as f:
+            f.write('TEST\nTEST\n')
+
+        strings = create_strings_from_dict(3, False, 2, CompactDict.load(filename))
+
+        self.assertTrue(strings == ['TEST TEST TEST', 'TEST TEST TEST'])
+
+class LineIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        LineIndex.directory = os.path.join(self.directory, 'cache')
+        LineIndex.block_size = 7
+        self.filename = os.path.join(self.directory, 'corpus.txt')
+        with open(self.filename, 'w', encoding='utf8') as f:
+            f.write(''.join('line {} été\n'.format(i) for i in range(20)) + 'last')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        LineIndex.directory = os.path.join('cache', 'lines')
+        LineIndex.block_size = 16 * 1024 * 1024
+
+    def test_line_index_random_access(self):
+        index = LineIndex.load(self.filename)
+
+        self.assertTrue(
+            len(index) == 21 and
+            index[3] == 'line 3 été' and
+            index[-1] == 'last' and
+            len(os.listdir(LineIndex.directory)) == 1
+        )
+
+    def test_line_index_sequential(self):
+        lines = list(islice(LineIndex.load(self.filename).iterate('sequential'), 23))
+
+        self.assertTrue(lines[0] == 'line 0 été' and lines[20] == 'last' and lines[22] == 'line 1 été')
+
+    def test_line_index_shuffle_without_replacement(self):
+        random.seed(3)
+        first = list(islice(LineIndex.load(self.filename).iterate('shuffle'), 42))
+        random.seed(3)
+        second = list(islice(LineIndex.load(self.filename).iterate('shuffle'), 42))
+
+        self.assertTrue(
+            first == second and
+            sorted(first[0:21]) == sorted(first[21:42]) and
+            len(set(first[0:21])) == 21
+        )
+
+    def test_line_index_uniform(self):
+        lines = list(islice(LineIndex.load(self.filename).iterate('uniform'), 200))
+
+        self.assertTrue(set(lines) <= set(LineIndex.load(self.filename)[i] for i in range(21)) and len(set(lines)) > 10)
+
+class AtomicFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'file.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_file_is_replaced_once_complete(self):
+        with open(self.path, 'w') as f:
+            f.write('old')
+
+        with atomic_open(self.path, 'w', encoding='utf-8') as f:
+            f.write('new')
+            with open(self.path) as current:
+                unchanged = current.read() == 'old'
+
+        with open(self.path) as f:
+            self.assertTrue(unchanged and f.read() == 'new' and os.listdir(self.directory) == ['file.json'])
+
+    def test_failed_write_leaves_nothing(self):
+        try:
+            with atomic_open(self.path) as f:
+                f.write(b'partial')
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertTrue(os.listdir(self.directory) == [])
+
+class StubWikipediaHandler(BaseHTTPRequestHandler):
+    requests_served = 0
+    requests_refused = 0
+
+    def do_GET(self):
+        if StubWikipediaHandler.requests_refused > 0:
+            StubWikipediaHandler.requests_refused -= 1
+            body = '<html><body><p>Too many requests were sent, please try again a bit later</p></body></html>'
+            self.send_response(429)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body.encode('utf-8'))
+            return
+
+        StubWikipediaHandler.requests_served += 1
+        body = '<html><body><script>var a = 1;</script>'
+        body += ''.join(
+            '<p>Sentence {} of page {} has quite a few words in it</p>\n'.format(i, StubWikipediaHandler.requests_served)
+            for i in range(8)
+        )
+        body += '<p>Wikipedia is mentioned here with enough words too</p></body></html>'
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body.encode('utf-8'))))
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, format, *args):
+        pass
+
+class WikipediaSourceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = HTTPServer(('127.0.0.1', 0), StubWikipediaHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        StubWikipediaHandler.requests_served = 0
+        StubWikipediaHandler.requests_refused = 0
+        WikipediaSource.url = 'http://127.0.0.1:{}/{{}}/random'.format(self.server.server_port)
+        WikipediaSource.directory = self.directory
+        WikipediaSource.max_in_flight = 4
+        WikipediaSource.reset()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+        WikipediaSource.url = 'https://{}.wikipedia.org/wiki/Special:Random'
+        WikipediaSource.directory = os.path.join('cache', 'wikipedia')
+        WikipediaSource.max_in_flight = 8
+        WikipediaSource.reset()
+
+    def test_sentences_are_fetched_concurrently(self):
+        sentences = WikipediaSource.sentences(5, 20, 'en')
+
+        self.assertTrue(
+            len(sentences) == 20 and
+            len(set(sentences)) == 20 and
+            all(len(s.split(' ')) > 5 and 'Wikipedia' not in s for s in sentences) and
+            StubWikipediaHandler.requests_served >= 7
+        )
+
+    def test_sentences_are_cached(self):
+        first = WikipediaSource.sentences(5, 6, 'en')
+        served = StubWikipediaHandler.requests_served
+        WikipediaSource.reset()
+        second = WikipediaSource.sentences(5, 6, 'en', max_length=30)
+
+        self.assertTrue(
+            len(first) == 6 and
+            len(second) == 6 and
+            all(len(s) <= 30 for s in second) and
+            StubWikipediaHandler.requests_served == served
+        )
+
+    def test_pages_are_served_once_per_run(self):
+        WikipediaSource.sentences(5, 40, 'en')
+        cached = StubWikipediaHandler.requests_served
+        WikipediaSource.reset()
+
+        batches = [WikipediaSource.sentences(5, 20, 'en') for _ in range(4)]
+        sentences = [s for batch in batches for s in batch]
+
+        self.assertTrue(
+            len(sentences) == 80 and
+            len(set(sentences)) == 80 and
+            StubWikipediaHandler.requests_served > cached
+        )
+
+    def test_error_pages_are_skipped(self):
+        StubWikipediaHandler.requests_refused = 3
+        sentences = WikipediaSource.sentences(5, 20, 'en')
+
+        with open(os.path.join(self.directory, 'en.jsonl'), 'r', encoding='utf-8') as f:
+            cached = [json.loads(line) for line in f]
+
+        self.assertTrue(
+            len(sentences) == 20 and
+            not any('requests' in s for s in sentences) and
+            len(cached) == StubWikipediaHandler.requests_served and
+            not any('requests' in line for page in cached for line in page)
+        )
+
 class CommandLineInterface(unittest.TestCase):
     def test_output_dir(self):
         args = ['python3', 'run.py', '-c', '1', '--output_dir', '../tests/out_2/']
@@ -320,6 +1318,58 @@ class CommandLineInterface(unittest.TestCase):
         self.assertTrue(len(os.listdir('tests/out/')) == 10)
         empty_directory('tests/out/')
 
+    def test_resume_skips_samples_already_in_shards(self):
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, 'lines.txt'), 'w') as f:
+            f.write('TEST\nTEST TEST\n')
+        args = [
+            'python3', 'run.py', '-l', 'latin', '-i', os.path.join(directory, 'lines.txt'), '-c', '12', '-t', '2',
+            '-sd', '4', '-of', 'tar', '--output_dir', os.path.join(directory, 'out')
+        ]
+
+        subprocess.Popen(args, cwd="TextRecognitionDataGenerator/").wait()
+        written_without_checkpoint = os.listdir(os.path.join(directory, 'out'))
+        shutil.rmtree(os.path.join(directory, 'out'))
+
+        subprocess.Popen(args + ['-ckpt'], cwd="TextRecognitionDataGenerator/").wait()
+        # Interrupted before the manifest caught up with the shards
+        manifest = ProgressManifest.load(os.path.join(directory, 'out'))
+        manifest.done[:] = False
+        manifest.save()
+        subprocess.Popen(args + ['-res'], cwd="TextRecognitionDataGenerator/").wait()
+
+        keys = []
+        for name in os.listdir(os.path.join(directory, 'out')):
+            if name.endswith('.tar'):
+                with tarfile.open(os.path.join(directory, 'out', name)) as tar:
+                    keys += [m.name for m in tar if m.name.endswith('.json')]
+        shutil.rmtree(directory)
+
+        self.assertTrue(
+            'progress.json' not in written_without_checkpoint and
+            len(keys) == 12 and len(set(keys)) == 12
+        )
+
+    def test_strings_are_created_in_batches(self):
+        directory = tempfile.mkdtemp()
+        args = [
+            'python3', 'run.py', '-l', 'latin', '-sjnk_latin', '-c', '1010', '-t', '4', '-b', '1', '-na', '2',
+            '-f', '16', '-sd', '1', '--output_dir', directory
+        ]
+        subprocess.Popen(args, cwd="TextRecognitionDataGenerator/").wait()
+
+        with open(os.path.join(directory, 'labels.txt'), 'r', encoding='utf8') as f:
+            labels = [l.rstrip('\n').split(' ', 1)[1] for l in f]
+        sample_count = len(os.listdir(directory)) - 1
+        shutil.rmtree(directory)
+
+        # Only spaces strings aside, the second batch does not replay the first one
+        first, second = set(l for l in labels[:1000] if l.strip()), [l for l in labels[1000:] if l.strip()]
+        self.assertTrue(
+            sample_count == 1010 and len(labels) == 1010 and
+            len(second) > 0 and not any(l in first for l in second)
+        )
+
     def test_random_sequences_letter_only(self):
         args = ['python3', 'run.py', '-rs', '-let', '-c', '1', '--output_dir', '../tests/out/']
         subprocess.Popen(args, cwd="TextRecognitionDataGenerator/").wait()